@@ -2,26 +2,40 @@
 
 """A very simple and lightweight issue tracker for Mercurial."""
 
-from mercurial import hg, util, commands, cmdutil, registrar
-from mercurial.i18n import _
-try:
-    from mercurial.utils.dateutil import parsedate,datestr,matchdate
-    from mercurial.utils.stringutil import shortuser
-    from mercurial.utils.procutil import system
-except:
-    from mercurial.util import parsedate,datestr,matchdate
-    from mercurial.util import shortuser
-    from mercurial.util import system
-import os, time, random, mailbox, glob, socket, ConfigParser
-import mimetypes
-from email import encoders
-from email.generator import Generator
-from email.mime.audio import MIMEAudio
-from email.mime.base import MIMEBase
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from itertools import izip
+import os, sys, re, time, glob, fnmatch, json, bisect, contextlib
+
+# Everything else (Mercurial included, unless it's the one loading us as an
+# extension) is imported by the functions that need it, so that loading the
+# extension, and git-artemis, stay cheap.
+class _hgmodule(object):
+    """Mercurial module NAME, imported on first use."""
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = __import__('mercurial.' + self._name, fromlist = [self._name])
+        return getattr(module, attr)
+
+def _hgfunction(name, module):
+    """Mercurial function NAME, from mercurial.utils.MODULE, or from
+    mercurial.util in older versions."""
+    try:
+        return getattr(__import__('mercurial.utils.' + module, fromlist = [module]), name)
+    except (ImportError, AttributeError):
+        return getattr(__import__('mercurial.util', fromlist = ['util']), name)
+
+def parsedate(*args, **kwargs): return _hgfunction('parsedate', 'dateutil')(*args, **kwargs)
+def datestr(*args, **kwargs):   return _hgfunction('datestr',   'dateutil')(*args, **kwargs)
+def matchdate(*args, **kwargs): return _hgfunction('matchdate', 'dateutil')(*args, **kwargs)
+def shortuser(*args, **kwargs): return _hgfunction('shortuser', 'stringutil')(*args, **kwargs)
+def system(*args, **kwargs):    return _hgfunction('system',    'procutil')(*args, **kwargs)
+
+if 'mercurial' in sys.modules:
+    from mercurial import commands, cmdutil, registrar
+    from mercurial.i18n import _
+else:
+    commands = _hgmodule('commands')
+    def _(message): return message
 
 
 state = { 'new':      ['new'],
@@ -29,95 +43,198 @@ state = { 'new':      ['new'],
 default_state = 'new'
 default_issues_dir = ".issues"
 filter_prefix = ".filter"
+index_file = ".index"
+ids_file = ".ids"
+search_file = ".search"
+socket_file = ".socket"
+blobs_dir = ".blobs"
+blob_access_type = 'x-artemis-blob'
+search_version = 1
+pack_version = 1
+index_version = 2
+stamp_width = 24                # of the time in .ids, so that it can be updated in place
+property_header = 'X-Artemis-Property'
 date_format = '%a, %d %b %Y %H:%M:%S %1%2'
 maildir_dirs = ['new','cur','tmp']
+chunk_size = 57 * 1024          # attachments are copied this much at a time (whole base64 lines)
 default_format = '%(id)s (%(len)3d) [%(state)s]: %(Subject)s'
 
 cmdtable = {}
-try:
-    command = registrar.command(cmdtable) # was cmdtable.command
-except:
-    command = cmdutil.command(cmdtable)
+if 'mercurial' in sys.modules:
+    try:
+        command = registrar.command(cmdtable) # was cmdtable.command
+    except:
+        command = cmdutil.command(cmdtable)
+else:
+    def command(name, options, synopsis):
+        def register(func):
+            cmdtable[name] = (func, options, synopsis)
+            return func
+        return register
 
 @command('ilist', [('a', 'all', False,
                     'list all issues (by default only those with state new)'),
                    ('p', 'property', [],
-                    'list issues with specific field values (e.g., -p state=fixed); lists all possible values of a property if no = sign'),
+                    'list issues with specific field values (e.g., -p state=fixed, -p state!=fixed, -p "state=new|open", -p "subject~=^crash"); lists all possible values of a property if no = sign'),
                    ('o', 'order', 'new', 'order of the issues; choices: "new" (date submitted), "latest" (date of the last message)'),
                    ('d', 'date', '', 'restrict to issues matching the date (e.g., -d ">12/28/2007)"'),
-                   ('f', 'filter', '', 'restrict to pre-defined filter (in %s/%s*)' % (default_issues_dir, filter_prefix))],
+                   ('f', 'filter', '', 'restrict to pre-defined filter (in %s/%s*)' % (default_issues_dir, filter_prefix)),
+                   ('j', 'jobs', 0, 'number of processes reading the issues in parallel'),
+                   ('r', 'rev', '', 'list the issues as of the given revision'),
+                   ('l', 'limit', 0, 'list at most the given number of issues'),
+                   ('', 'offset', 0, 'skip the given number of issues first'),
+                   ('', 'since-id', '', 'list only the issues after the given one (in the order of the list)'),
+                   ('', 'unordered', None, 'write every issue as soon as it matches, in no particular order'),
+                   ('', 'timing', None, 'report the time spent in each phase and on the slowest issues')],
                   _('hg ilist [OPTIONS]'))
 def ilist(ui, repo, **opts):
     """List issues associated with the project"""
 
+    server = not opts.get('rev') and not _profiling(ui, opts) and _connect(ui, repo)
+    if server:
+        status = _remote(ui, server, 'ilist', (), opts)
+        if status is not _unanswered: return status
+
+    profile = _profile(ui, opts)
+    try:
+        _ilist(ui, repo, profile, **opts)
+    finally:
+        if profile: profile.finish(ui)
+
+def _ilist(ui, repo, profile, **opts):
     # Process options
     show_all = opts['all']
     properties = []
-    match_date, date_match = False, lambda x: True
-    if opts['date']:
-        match_date, date_match = True, matchdate(opts['date'])
     order = 'new'
     if opts['order']:
         order = opts['order']
 
-    # Formats
-    formats = _read_formats(ui)
-
     # Find issues
     issues_dir = ui.config('artemis', 'issues', default = default_issues_dir)
     issues_path = os.path.join(repo.root, issues_dir)
-    if not os.path.exists(issues_path): return
-
-    issues = glob.glob(os.path.join(issues_path, '*'))
-
-    _create_all_missing_dirs(issues_path, issues)
-
-    # Process filter
-    if opts['filter']:
-        filters = glob.glob(os.path.join(issues_path, filter_prefix + '*'))
-        config = ConfigParser.SafeConfigParser()
-        config.read(filters)
-        if not config.has_section(opts['filter']):
-            ui.write('No filter %s defined\n' % opts['filter'])
+    snapshot = None
+    if opts.get('rev'):
+        with _phase(profile, 'discover'):
+            snapshot = RevisionIssues(RevisionFiles(repo, opts['rev']), os.path.relpath(issues_path, repo.root))
+    elif not os.path.exists(issues_path):
+        return
+    else:
+        with _phase(profile, 'discover'):
+            issues = glob.glob(os.path.join(issues_path, '*'))
+            _create_all_missing_dirs(issues_path, issues)
+
+    results = None
+    try:
+        with _phase(profile, 'setup'):
+            # Formats
+            formats = _read_formats(ui)
+
+            # Process filter
+            if opts['filter']:
+                properties += _filter_properties(ui, issues_path, opts['filter'])
+
+            cmd_properties = _get_properties(opts['property'])
+            list_properties = [p[0] for p in cmd_properties if len(p) == 1]
+            list_properties_dict = {}
+            properties += filter(lambda p: len(p) > 1, cmd_properties)
+
+            ids = None
+            if formats.uses('shortid'):
+                ids = snapshot and snapshot.ids or _issue_ids(issues_path)
+            query = IssueQuery(properties, show_all, opts['date'], order, list_properties, formats, ids)
+            jobs = _jobs(ui, opts)
+
+        index = None
+        if not snapshot:
+            with _phase(profile, 'index load'):
+                index = _open_index(issues_path)
+            issue_ids = [i[len(issues_path)+1:] for i in issues]   # +1 for trailing /
+        # The results are produced lazily (except when profiling), so that they
+        # can be written as they come, or stop being produced once enough are in
+        if snapshot:
+            with _phase(profile, 'scan'):
+                results = (_query_issue(query, issue_id, _thread_entry(IssueThread(mbox)), profile)
+                           for issue_id, mbox in snapshot.maildirs())
+                if profile: results = list(results)
+        elif index:
+            with _phase(profile, 'index update'):
+                entries = index.update(issues, issue_ids, jobs, profile)
+                index.prune(issue_ids)
+            with _phase(profile, 'query'):
+                candidates = query.candidates(index)
+                results = (_query_issue(query, issue_id, entry, profile) for issue_id, entry in zip(issue_ids, entries)
+                                                                         if candidates is None or issue_id in candidates)
+                if profile: results = list(results)
+            with _phase(profile, 'index save'):
+                index.save()
+        elif profile:
+            with _phase(profile, 'scan'):
+                results = []
+                for issue_id, (result, stats) in zip(issue_ids, _map(jobs, _scan_issue_profiled,
+                                                                    [(issue, issue_id, query) for issue, issue_id in zip(issues, issue_ids)])):
+                    profile.issue(issue_id, **stats)
+                    results.append(result)
         else:
-            properties += config.items(opts['filter'])
-
-    cmd_properties = _get_properties(opts['property'])
-    list_properties = [p[0] for p in cmd_properties if len(p) == 1]
-    list_properties_dict = {}
-    properties += filter(lambda p: len(p) > 1, cmd_properties)
+            results = _imap(jobs, _scan_issue, [(issue, issue_id, query) for issue, issue_id in zip(issues, issue_ids)])
+
+        if list_properties:
+            with _phase(profile, 'sort'):
+                for result in results:
+                    if result is None: continue
+                    for lp, value in result:
+                        list_properties_dict.setdefault(lp, set()).add(value)
+            with _phase(profile, 'output'):
+                for lp in list_properties_dict.keys():
+                    ui.write("%s:\n" % lp)
+                    for value in sorted(list_properties_dict[lp]):
+                        ui.write("  %s\n" % value)
+            return
 
-    summaries = []
-    for issue in issues:
-        mbox = mailbox.Maildir(issue, factory=mailbox.MaildirMessage)
-        root = _find_root_key(mbox)
-        if not root: continue
-        property_match = True
-        for property,value in properties:
-            if value:
-                property_match = property_match and (mbox[root][property] == value)
+        with _phase(profile, 'sort'):
+            summaries = (r for r in results if r is not None)
+            if opts.get('since_id'):
+                cursor = _since_key(ui, query, opts['since_id'], ids or (snapshot and snapshot.ids) or _issue_ids(issues_path),
+                                    snapshot, index, issues_path)
+                if cursor is None: return
+                summaries = (r for r in summaries if r[1] < cursor)
+            offset, limit = int(opts.get('offset') or 0), int(opts.get('limit') or 0)
+            if opts.get('unordered'):
+                import itertools
+                summaries = itertools.islice(summaries, offset, limit and offset + limit or None)
+            elif limit:
+                import heapq                # a heap of offset + limit issues, not a list of all
+                summaries = heapq.nlargest(offset + limit, summaries, key = lambda r: r[1])[offset:]
             else:
-                property_match = property_match and (property not in mbox[root])
-
-        if not show_all and (not properties or not property_match) and (properties or mbox[root]['State'].upper() in [f.upper() for f in state['resolved']]): continue
-        if match_date and not date_match(parsedate(mbox[root]['date'])[0]): continue
-
-        if not list_properties:
-            summaries.append((_summary_line(mbox, root, issue[len(issues_path)+1:], formats),     # +1 for trailing /
-                              _find_mbox_date(mbox, root, order)))
-        else:
-            for lp in list_properties:
-                if lp in mbox[root]:    list_properties_dict.setdefault(lp, set()).add(mbox[root][lp])
-
-    if not list_properties:
-        summaries.sort(lambda (s1,d1),(s2,d2): cmp(d2,d1))
-        for s,d in summaries:
-            ui.write(s + '\n')
+                summaries = sorted(summaries, key = lambda r: r[1], reverse = True)[offset:]
+
+        with _phase(profile, 'output'):
+            for s,d in summaries:
+                ui.write(s + '\n')
+    finally:
+        if hasattr(results, 'close'): results.close()       # stops the workers of an unfinished scan
+        if snapshot: snapshot.close()
+
+def _since_key(ui, query, since_id, ids, snapshot, index, issues_path):
+    """Return the sort key of the issue SINCE_ID (a prefix of its id, looked
+    up in IDS), or None if there is no such issue."""
+    issue_id = _lookup_issue(ui, ids, since_id)
+    if not issue_id:
+        ui.warn('No such issue\n')
+        return None
+    if snapshot:
+        mbox = snapshot.maildir(issue_id)
+        try:
+            entry = _thread_entry(IssueThread(mbox))
+        finally:
+            mbox.close()
+    elif index and issue_id in index.entries:
+        entry = index.entries[issue_id]
     else:
-        for lp in list_properties_dict.keys():
-            ui.write("%s:\n" % lp)
-            for value in sorted(list_properties_dict[lp]):
-                ui.write("  %s\n" % value)
+        entry = _index_entry(os.path.join(issues_path, issue_id))
+    if not entry['root']:
+        ui.warn('Issue %s has no messages\n' % issue_id)
+        return None
+    return query.sort_key(issue_id, entry)
 
 
 @command('iadd', [('a', 'attach', [],
@@ -147,9 +264,8 @@ def iadd(ui, repo, id = None, comment = 0, **opts):
             ui.warn('No such issue\n')
             return
         _create_missing_dirs(issues_path, issue_id)
-        mbox = mailbox.Maildir(issue_fn, factory=mailbox.MaildirMessage)
-        keys = _order_keys_date(mbox)
-        root = keys[0]
+        mbox = _open_issue(issue_fn)
+        thread = IssueThread(mbox)
 
     user = ui.username()
 
@@ -158,7 +274,7 @@ def iadd(ui, repo, id = None, comment = 0, **opts):
         default_issue_text +=     "State: %s\n" % default_state
         default_issue_text +=     "Subject: brief description\n\n"
     else:
-        subject = mbox[(comment < len(mbox) and keys[comment]) or root]['Subject']
+        subject = thread.headers(comment < len(thread) and comment or 0)['Subject']
         if not subject.startswith('Re: '): subject = 'Re: ' + subject
         default_issue_text +=     "Subject: %s\n\n" % subject
     default_issue_text +=         "Detailed description."
@@ -193,11 +309,8 @@ def iadd(ui, repo, id = None, comment = 0, **opts):
                      (user, datestr(format = date_format), properties_subject)
 
     # Create the message
+    import mailbox, socket
     msg = mailbox.MaildirMessage(issue)
-    if opts['attach']:
-        outer = _attach_files(msg, opts['attach'])
-    else:
-        outer = msg
 
     # Pick random filename
     if not id:
@@ -205,211 +318,2033 @@ def iadd(ui, repo, id = None, comment = 0, **opts):
         while os.path.exists(issue_fn):
             issue_id = _random_id()
             issue_fn = os.path.join(issues_path, issue_id)
-        mbox = mailbox.Maildir(issue_fn, factory=mailbox.MaildirMessage)
-        keys = _order_keys_date(mbox)
+        mbox = _open_issue(issue_fn, _storage(ui) == 'packed')
+        thread = IssueThread(mbox)
     # else: issue_fn already set
 
     # Add message to the mailbox
     mbox.lock()
-    if id and comment >= len(mbox):
+    if id and comment >= len(thread):
         ui.warn('No such comment number in mailbox, commenting on the issue itself\n')
 
     if not id:
-        outer.add_header('Message-Id', "<%s-0-artemis@%s>" % (issue_id, socket.gethostname()))
+        msg.add_header('Message-Id', "<%s-0-artemis@%s>" % (issue_id, socket.gethostname()))
     else:
-        root = keys[0]
-        outer.add_header('Message-Id', "<%s-%s-artemis@%s>" % (issue_id, _random_id(), socket.gethostname()))
-        outer.add_header('References', mbox[(comment < len(mbox) and keys[comment]) or root]['Message-Id'])
-        outer.add_header('In-Reply-To', mbox[(comment < len(mbox) and keys[comment]) or root]['Message-Id'])
-    new_bug_path = issue_fn + '/new/' + mbox.add(outer)
-    commands.add(ui, repo, new_bug_path)
+        msg.add_header('Message-Id', "<%s-%s-artemis@%s>" % (issue_id, _random_id(), socket.gethostname()))
+        parent = thread.headers(comment < len(thread) and comment or 0)
+        msg.add_header('References', parent['Message-Id'])
+        msg.add_header('In-Reply-To', parent['Message-Id'])
+        if properties and _property_changes(ui) == 'append':
+            # Recorded in the new message, and folded in when the issue is read
+            for property, value in properties:
+                msg.add_header(property_header, '%s=%s' % (property, value))
+            properties = []
+    blobs = None
+    if opts['attach'] and _attachments(ui) != 'inline':
+        blobs = IssueBlobs(issues_path, _attachments(ui) == 'compressed-blobs')
+    if opts['attach']:
+        key = mbox.add_file(lambda fp: _attach_files(fp, msg, opts['attach'], blobs))
+    else:
+        key = mbox.add(msg)
+    if not id or not isinstance(mbox, IssuePack):   # a pack is added with its first message
+        commands.add(ui, repo, mbox.path(key))
+    if blobs and blobs.added:
+        commands.add(ui, repo, *blobs.added)
+    thread.refresh(key)
 
     # Fix properties in the root message
     if properties:
-        root = _find_root_key(mbox)
-        msg = mbox[root]
-        for property, value in properties:
-            if property in msg:
-                msg.replace_header(property, value)
-            else:
-                msg.add_header(property, value)
-        mbox[root] = msg
+        mbox.set_headers(thread.root, properties)
+        thread.refresh(thread.root)
 
     mbox.close()
 
     if opts['commit']:
-        commands.commit(ui, repo, issue_fn)
+        commands.commit(ui, repo, issue_fn, *(blobs and blobs.added or []))
 
     # If adding issue, add the new mailbox to the repository
     if not id:
         ui.status('Added new issue %s\n' % issue_id)
     else:
-        _show_mbox(ui, mbox, 0)
+        _show_mbox(ui, thread, 0)
 
-@command('ishow', [('a', 'all', None, 'list all comments'),
+@command('ishow', [('a', 'all', None, 'list all comments (or, given a COMMENT, all replies under it)'),
+                   ('', 'tail', 0, 'list only the last N of the comments'),
                    ('s', 'skip', '>', 'skip lines starting with a substring'),
                    ('x', 'extract', [], 'extract attachments (provide attachment number as argument)'),
+                   ('r', 'rev', '', 'show the issue as of the given revision'),
                    ('', 'mutt', False, 'use mutt to show issue')],
                   _('hg ishow [OPTIONS] ID [COMMENT]'))
 def ishow(ui, repo, id, comment = 0, **opts):
-    """Shows issue ID, or possibly its comment COMMENT"""
+    """Shows issue ID, or possibly its comment COMMENT (or comments FIRST:LAST)"""
 
-    comment = int(comment)
-    issue, id = _find_issue(ui, repo, id)
-    if not issue:
-        return ui.warn('No such issue\n')
+    server = not opts.get('extract') and not opts.get('mutt') and not opts.get('rev') and _connect(ui, repo)
+    if server:
+        status = _remote(ui, server, 'ishow', (id, comment), opts)
+        if status is not _unanswered: return status
 
+    comments = None
+    if ':' in str(comment):
+        first, last = str(comment).split(':', 1)
+        comments = (int(first or 0), int(last) if last else None)
+        comment = 0
+    comment = int(comment)
     issues_dir = ui.config('artemis', 'issues', default = default_issues_dir)
-    _create_missing_dirs(os.path.join(repo.root, issues_dir), issue)
-
-    if opts.get('mutt'):
-        return system('mutt -R -f %s' % issue)
-
-    mbox = mailbox.Maildir(issue, factory=mailbox.MaildirMessage)
-
-    if opts['all']:
-        ui.write('='*70 + '\n')
-        i = 0
-        keys = _order_keys_date(mbox)
-        for k in keys:
-            _write_message(ui, mbox[k], i, skip = opts['skip'])
-            ui.write('-'*70 + '\n')
-            i += 1
+    if opts.get('rev'):
+        if opts.get('mutt'):
+            return ui.warn('Cannot use mutt to show an issue at a revision\n')
+        issues_path = os.path.join(repo.root, issues_dir)
+        snapshot = RevisionIssues(RevisionFiles(repo, opts['rev']), os.path.relpath(issues_path, repo.root))
+        id = _lookup_issue(ui, snapshot.ids, id)
+        if not id:
+            return ui.warn('No such issue\n')
+        thread = IssueThread(snapshot.maildir(id))
+    else:
+        issue, id = _find_issue(ui, repo, id)
+        if not issue:
+            return ui.warn('No such issue\n')
+
+        _create_missing_dirs(os.path.join(repo.root, issues_dir), issue)
+        mbox = _open_issue(issue)
+
+        if opts.get('mutt'):
+            if isinstance(mbox, IssuePack):
+                return ui.warn('Cannot use mutt to show a packed issue\n')
+            return system('mutt -R -f %s' % issue)
+
+        thread = IssueThread(mbox)
+
+    # Only the messages in the window are read, as they are written
+    if comments or opts['all'] or opts.get('tail'):
+        if comments:
+            first, last = comments
+            if last is None or last >= len(thread): last = len(thread) - 1
+            indexes = xrange(first, last + 1)
+        elif comment and comment < len(thread):
+            indexes = [comment] + [i for i, depth in thread.replies(comment)]
+        else:
+            if comment: ui.warn('Comment out of range, showing the whole issue\n')
+            indexes = xrange(len(thread))
+        if opts.get('tail'):
+            indexes = list(indexes)[-int(opts['tail']):]
+        if not indexes:
+            return ui.warn('No comments in range (the issue has %d messages)\n' % len(thread))
+        _show_messages(ui, thread, indexes, skip = opts['skip'])
         return
 
-    _show_mbox(ui, mbox, comment, skip = opts['skip'])
+    _show_mbox(ui, thread, comment, skip = opts['skip'])
 
     if opts['extract']:
         attachment_numbers = map(int, opts['extract'])
-        keys = _order_keys_date(mbox)
-        msg = mbox[keys[comment]]
+        blobs = IssueBlobs(os.path.join(repo.root, issues_dir))
+        msg = thread.open(comment)
         counter = 1
-        for part in msg.walk():
+        for part, lines in MessageParts(msg):
             ctype = part.get_content_type()
             maintype, subtype = ctype.split('/', 1)
             if maintype == 'multipart' or ctype == 'text/plain': continue
             if counter in attachment_numbers:
+                blob, part = _blob_reference(part, lines)
                 filename = part.get_filename()
                 if not filename:
+                    import mimetypes
                     ext = mimetypes.guess_extension(part.get_content_type()) or ''
                     filename = 'attachment-%03d%s' % (counter, ext)
                 else:
                     filename = os.path.basename(filename)
                 fp = open(filename, 'wb')
-                fp.write(part.get_payload(decode = True))
+                if blob:
+                    chunks = blobs.read(blob)
+                else:
+                    chunks = _decode_lines(lines, part['Content-Transfer-Encoding'])
+                for chunk in chunks:
+                    fp.write(chunk)
                 fp.close()
             counter += 1
+        msg.close()
+
+
+@command('iindex', [('', 'verify', False, 'check the index against the issues instead of rebuilding it'),
+                    ('j', 'jobs', 0, 'number of processes reading the issues in parallel')],
+                   _('hg iindex [OPTIONS]'))
+def iindex(ui, repo, **opts):
+    """Rebuild (or verify) the index of issue summaries used by ilist"""
+
+    issues_dir = ui.config('artemis', 'issues', default = default_issues_dir)
+    issues_path = os.path.join(repo.root, issues_dir)
+    if not os.path.exists(issues_path): return
+
+    issues = glob.glob(os.path.join(issues_path, '*'))
+    _create_all_missing_dirs(issues_path, issues)
+
+    if not opts['verify']:
+        index = IssueIndex(issues_path, load = False)
+        index.update(issues, [i[len(issues_path)+1:] for i in issues], _jobs(ui, opts))
+        index.save()
+        ui.status('Indexed %d issues\n' % len(issues))
+        return
+
+    index = _open_index(issues_path)
+    if not index:
+        ui.warn('No index in %s (run iindex to create it)\n' % issues_dir)
+        return 1
+
+    problems = 0
+    for issue in issues:
+        issue_id = issue[len(issues_path)+1:]
+        if issue_id not in index.entries:
+            ui.write('%s: missing\n' % issue_id)
+            problems += 1
+            continue
+        cached, entry = index.entries[issue_id], _index_entry(issue)
+        if cached['stamp'] != _issue_stamp(issue):
+            ui.note('%s: stale\n' % issue_id)
+        elif any(cached[k] != entry[k] for k in entry):
+            ui.write('%s: out of date\n' % issue_id)
+            problems += 1
+    for issue_id in set(index.entries) - set(i[len(issues_path)+1:] for i in issues):
+        ui.write('%s: no such issue\n' % issue_id)
+        problems += 1
+
+    ui.status('%d issues, %d problems\n' % (len(issues), problems))
+    return problems and 1 or 0
+
+
+@command('isearch', [('p', 'property', [],
+                      'restrict to issues with specific field values (e.g., -p state=fixed)'),
+                     ('d', 'date', '', 'restrict to issues matching the date (e.g., -d ">12/28/2007)"'),
+                     ('f', 'filter', '', 'restrict to pre-defined filter (in %s/%s*)' % (default_issues_dir, filter_prefix)),
+                     ('j', 'jobs', 0, 'number of processes reading the issues in parallel')],
+                    _('hg isearch [OPTIONS] TEXT...'))
+def isearch(ui, repo, *words, **opts):
+    """Search the subjects and the text of the messages for all the words TEXT"""
+
+    server = _connect(ui, repo)
+    if server:
+        status = _remote(ui, server, 'isearch', words, opts)
+        if status is not _unanswered: return status
+
+    formats = _read_formats(ui)
+
+    issues_dir = ui.config('artemis', 'issues', default = default_issues_dir)
+    issues_path = os.path.join(repo.root, issues_dir)
+    if not os.path.exists(issues_path): return
+
+    issues = glob.glob(os.path.join(issues_path, '*'))
+    _create_all_missing_dirs(issues_path, issues)
+    issue_ids = [i[len(issues_path)+1:] for i in issues]
+
+    properties = []
+    if opts['filter']:
+        properties += _filter_properties(ui, issues_path, opts['filter'])
+    properties += [p for p in _get_properties(opts['property']) if len(p) > 1]
+
+    search = SearchIndex(issues_path)
+    search.update(issues, issue_ids, _jobs(ui, opts))
+    hits = search.search(' '.join(words))
+
+    # Restrict the matching issues; without properties, search all of them
+    ids = formats.uses('shortid') and _issue_ids(issues_path) or None
+    query = IssueQuery(properties, not properties, opts['date'], 'new', [], formats, ids)
+    index = _open_index(issues_path)
+    scores = {}
+    for (issue_id, key), score in hits.iteritems():
+        scores[issue_id] = max(scores.get(issue_id, 0), score)
+    for issue_id in sorted(scores, key = lambda i: (-scores[i], i)):
+        issue = os.path.join(issues_path, issue_id)
+        entry = (index and index.get(issue, issue_id)) or _index_entry(issue)
+        result = query(issue_id, entry)
+        if result is None: continue
+
+        ui.write(result[0] + '\n')
+        thread = IssueThread(_open_issue(issue))
+        for i,k in enumerate(thread.keys):
+            if (issue_id, k) not in hits: continue
+            msg = thread.headers(i)
+            ui.write('  %d: [%s] %s\n' % (i, shortuser(msg['From']), msg['Subject']))
+
+    if index: index.save()
+
+
+@command('istats', [('a', 'all', False, 'count all issues (by default only those with state new)'),
+                    ('p', 'property', [], 'restrict to issues with specific field values, as in ilist'),
+                    ('d', 'date', '', 'restrict to issues matching the date (e.g., -d ">12/28/2007)"'),
+                    ('f', 'filter', '', 'restrict to pre-defined filter (in %s/%s*)' % (default_issues_dir, filter_prefix)),
+                    ('g', 'group', [], 'group the issues by the given property (e.g., -g state -g assigned)'),
+                    ('b', 'bucket', '', 'group the issues by their date; choices: "year", "month", "week", "day"'),
+                    ('', 'latest', None, 'bucket the issues by the date of their latest message, not the first'),
+                    ('r', 'rev', '', 'count the issues as of the given revision'),
+                    ('j', 'jobs', 0, 'number of processes reading the issues in parallel'),
+                    ('', 'json', None, 'write the statistics as JSON')],
+                   _('hg istats [OPTIONS]'))
+def istats(ui, repo, **opts):
+    """Count the issues, their replies and their ages, by property and date"""
+
+    server = not opts.get('rev') and _connect(ui, repo)
+    if server:
+        status = _remote(ui, server, 'istats', (), opts)
+        if status is not _unanswered: return status
+
+    bucket = opts['bucket']
+    if bucket and bucket not in _stats_buckets:
+        ui.warn('Unknown bucket %s (choices: %s)\n' % (bucket, ', '.join(sorted(_stats_buckets))))
+        return 1
+
+    issues_dir = ui.config('artemis', 'issues', default = default_issues_dir)
+    issues_path = os.path.join(repo.root, issues_dir)
+    if not opts.get('rev') and not os.path.exists(issues_path):
+        return
+
+    properties = []
+    if opts['filter']:
+        properties += _filter_properties(ui, issues_path, opts['filter'])
+    properties += [p for p in _get_properties(opts['property']) if len(p) > 1]
+    query = IssueQuery(properties, opts['all'], opts['date'], 'new', [], None)
+
+    # A single scan: of the revision, of the index, or of the issues
+    if opts.get('rev'):
+        snapshot = RevisionIssues(RevisionFiles(repo, opts['rev']), os.path.relpath(issues_path, repo.root))
+        entries = ((issue_id, _thread_entry(IssueThread(mbox))) for issue_id, mbox in snapshot.maildirs())
+    else:
+        issues = glob.glob(os.path.join(issues_path, '*'))
+        _create_all_missing_dirs(issues_path, issues)
+        issue_ids = [i[len(issues_path)+1:] for i in issues]
+        index = _open_index(issues_path)
+        if index:
+            entries = zip(issue_ids, index.update(issues, issue_ids, _jobs(ui, opts)))
+            candidates = query.candidates(index)
+            if candidates is not None:
+                entries = [(issue_id, entry) for issue_id, entry in entries if issue_id in candidates]
+            index.prune(issue_ids)
+            index.save()
+        else:
+            entries = zip(issue_ids, _map(_jobs(ui, opts), _index_entry, issues))
+
+    stats = IssueStats([g.lower() for g in opts['group']], bucket, opts['latest'])
+    for issue_id, entry in entries:
+        if query.match(issue_id, entry) is not None:
+            stats.add(entry)
+    if opts.get('rev'): snapshot.close()
+
+    if opts['json']:
+        ui.write(json.dumps(stats.report(), indent = 1, separators = (',', ': '), sort_keys = True) + '\n')
+    else:
+        stats.write(ui)
+
+
+@command('iexport', [('a', 'all', False, 'export all issues (by default only those with state new)'),
+                     ('p', 'property', [], 'restrict to issues with specific field values, as in ilist'),
+                     ('d', 'date', '', 'restrict to issues matching the date (e.g., -d ">12/28/2007)"'),
+                     ('f', 'filter', '', 'restrict to pre-defined filter (in %s/%s*)' % (default_issues_dir, filter_prefix)),
+                     ('', 'since', '', 'export only the issues changed since the revision, or the date'),
+                     ('m', 'messages', None, 'export a record per message, instead of per issue'),
+                     ('o', 'output', '', 'write the records to the file, instead of the standard output'),
+                     ('j', 'jobs', 0, 'number of processes reading the issues in parallel')],
+                    _('hg iexport [OPTIONS]'))
+def iexport(ui, repo, **opts):
+    """Export the issues, or their messages, as JSON, an object per line"""
+
+    issues_dir = ui.config('artemis', 'issues', default = default_issues_dir)
+    issues_path = os.path.join(repo.root, issues_dir)
+    if not os.path.exists(issues_path):
+        return
+
+    properties = []
+    if opts['filter']:
+        properties += _filter_properties(ui, issues_path, opts['filter'])
+    properties += [p for p in _get_properties(opts['property']) if len(p) > 1]
+    query = IssueQuery(properties, opts['all'], opts['date'], 'new', [], None)
+
+    issues = glob.glob(os.path.join(issues_path, '*'))
+    _create_all_missing_dirs(issues_path, issues)
+    if opts['since']:
+        changed = _changed_issues(repo, issues_path, issues, opts['since'])
+        issues = [i for i in issues if i[len(issues_path)+1:] in changed]
+    issues.sort()
+    issue_ids = [i[len(issues_path)+1:] for i in issues]
+
+    index = _open_index(issues_path)
+    if index:
+        entries = index.update(issues, issue_ids, _jobs(ui, opts))
+        if not opts['since']: index.prune(issue_ids)
+        index.save()
+    else:
+        entries = _map(_jobs(ui, opts), _index_entry, issues)
+
+    # A record at a time, and a message at a time
+    fp = opts['output'] and open(opts['output'], 'w')
+    write = fp and fp.write or ui.write
+    try:
+        for issue, issue_id, entry in zip(issues, issue_ids, entries):
+            if query.match(issue_id, entry) is None: continue
+            if not opts['messages']:
+                records = [_issue_record(issue_id, entry)]
+            else:
+                thread = IssueThread(_open_issue(issue))
+                records = (_message_record(issue_id, thread, i) for i in xrange(len(thread)))
+            for record in records:
+                write(json.dumps(record, sort_keys = True) + '\n')
+    finally:
+        if fp: fp.close()
+
+
+@command('iimport', [('', 'format', '', 'format of SOURCE: mbox, maildir, or json (guessed by default)'),
+                     ('c', 'commit', False, 'perform a commit after the import')],
+                    _('hg iimport [OPTIONS] SOURCE'))
+def iimport(ui, repo, source, **opts):
+    """Import issues and comments from SOURCE, an mbox, maildirs, or JSON lines"""
+
+    issues_dir = ui.config('artemis', 'issues', default = default_issues_dir)
+    issues_path = os.path.join(repo.root, issues_dir)
+    if not os.path.exists(issues_path): os.mkdir(issues_path)
+
+    format = opts['format']
+    if not format:
+        if os.path.isdir(source):               format = 'maildir'
+        elif source.endswith(('.json', '.jsonl')):  format = 'json'
+        else:                                   format = 'mbox'
+    if format not in _import_readers:
+        ui.warn('Unknown format %s\n' % format)
+        return 1
+
+    wlock = getattr(repo, 'wlock', None)
+    wlock = wlock and wlock()
+    try:
+        blobs = None
+        if _attachments(ui) != 'inline':
+            blobs = IssueBlobs(issues_path, _attachments(ui) == 'compressed-blobs')
+        importer = IssueImporter(issues_path, _storage(ui) == 'packed', _property_changes(ui) == 'append', blobs)
+        for msg, properties in _import_readers[format](source):
+            importer.add(msg, properties)
+        importer.finish()
+
+        if importer.paths:
+            commands.add(ui, repo, *sorted(set(importer.paths)))
+        if blobs and blobs.added:
+            commands.add(ui, repo, *blobs.added)
+        if opts['commit'] and importer.messages:
+            commands.commit(ui, repo, issues_path)
+    finally:
+        if wlock: wlock.release()
+
+    ui.status('Imported %d messages: %d new issues, %d comments on existing issues\n' %
+              (importer.messages, len(importer.new_issues), importer.existing_comments))
+
+
+@command('icompact', [('c', 'commit', False, 'perform a commit after compacting')],
+                     _('hg icompact [OPTIONS] [ID]'))
+def icompact(ui, repo, id = None, **opts):
+    """Fold the property changes recorded in comments into the root messages of issue ID, or of all issues"""
+
+    issues_dir = ui.config('artemis', 'issues', default = default_issues_dir)
+    issues_path = os.path.join(repo.root, issues_dir)
+    if id:
+        issue, id = _find_issue(ui, repo, id)
+        if not issue:
+            return ui.warn('No such issue\n')
+        issues = [issue]
+    elif not os.path.exists(issues_path):
+        return
+    else:
+        issues = glob.glob(os.path.join(issues_path, '*'))
+    _create_all_missing_dirs(issues_path, issues)
+
+    compacted = []
+    for issue in sorted(issues):
+        mbox = _open_issue(issue)
+        thread = IssueThread(mbox)
+        changes = thread.root and list(thread.changes())
+        if changes:
+            mbox.lock()
+            properties = thread.properties()
+            names = []
+            for i, name, value in changes:
+                if name.lower() not in [n.lower() for n in names]: names.append(name)
+            mbox.set_headers(thread.root, [(name, properties[name]) for name in names])
+            for i in sorted(set(i for i, name, value in changes)):
+                mbox.set_headers(thread.keys[i], [(property_header, None)])
+            compacted.append(issue)
+        mbox.close()
+    ui.status('Compacted %d issues\n' % len(compacted))
+
+    if opts['commit'] and compacted:
+        commands.commit(ui, repo, id and compacted[0] or issues_path)
+
+
+@command('iserve', [('', 'stop', None, 'stop the server running for the repository')],
+                   _('hg iserve [OPTIONS]'))
+def iserve(ui, repo, **opts):
+    """Keep the issues in memory, and serve ilist, ishow, isearch and istats from them"""
+
+    issues_dir = ui.config('artemis', 'issues', default = default_issues_dir)
+    issues_path = os.path.join(repo.root, issues_dir)
+    if not os.path.exists(issues_path): os.mkdir(issues_path)
+
+    if opts['stop']:
+        server = _connect(ui, repo)
+        if not server:
+            ui.warn('No server is running\n')
+            return 1
+        status = _remote(ui, server, 'stop', (), {})
+        return 1 if status is _unanswered else status
+
+    server = IssueServer(ui, repo, issues_path)
+    if not server.bind():
+        ui.warn('A server is already running\n')
+        return 1
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
 
 
 def _find_issue(ui, repo, id):
     issues_dir = ui.config('artemis', 'issues', default = default_issues_dir)
     issues_path = os.path.join(repo.root, issues_dir)
-    if not os.path.exists(issues_path): return False
+    if not os.path.exists(issues_path): return False, 0
+
+    issue_id = _lookup_issue(ui, _issue_ids(issues_path), id)
+    if not issue_id: return False, 0
+    return os.path.join(issues_path, issue_id), issue_id
 
-    issues = glob.glob(os.path.join(issues_path, id + '*'))
+def _lookup_issue(ui, ids, id):
+    """Return the issue id in IDS (an IssueIds) that starts with ID, or None
+    if there is none, or more than one (which are listed)."""
+    issues = ids.lookup(id)
 
     if len(issues) == 0:
-        return False, 0
+        return None
     elif len(issues) > 1:
         ui.status("Multiple choices:\n")
-        for i in issues: ui.status('  ', i[len(issues_path)+1:], '\n')
-        return False, 0
-
-    return issues[0], issues[0][len(issues_path)+1:]
+        for i in issues: ui.status('  %s (%s)\n' % (i, ids.shortest(i)))
+        return None
+
+    return issues[0]
+
+def _changed_issues(repo, issues_path, issues, since):
+    """Return the ids of the ISSUES (paths) in ISSUES_PATH changed since the
+    revision SINCE, or else the date SINCE."""
+    try:
+        files = RevisionFiles(repo, since)
+    except Exception:
+        error = sys.exc_info()
+        try:
+            when = parsedate(since)[0]
+        except Exception:
+            raise error[0], error[1], error[2]      # neither: complain about the revision
+        return set(i[len(issues_path)+1:] for i in issues if max(_issue_stamp(i)) > when)
+
+    issues_dir = os.path.relpath(issues_path, repo.root)
+    try:
+        paths = files.changed(issues_dir)
+    finally:
+        files.close()
+    return set(p[len(issues_dir)+1:].split('/')[0] for p in paths)
+
+def _export_text(data, charset = None):
+    """DATA as unicode, decoded from CHARSET if it's given (and right), or from
+    UTF-8, or else from Latin-1, which always works."""
+    for c in (charset, 'utf-8'):
+        try:
+            if c: return data.decode(c)
+        except (UnicodeError, LookupError):
+            pass
+    return data.decode('latin-1')
+
+def _issue_record(issue_id, entry):
+    """The iexport record of an issue, made of its index ENTRY."""
+    headers = {}
+    for k,v in entry['headers']:
+        headers.setdefault(_export_text(k), _export_text(v))
+    return { 'issue': issue_id, 'properties': headers, 'messages': entry['len'],
+             'first': entry['first'], 'latest': entry['latest'] }
+
+def _message_record(issue_id, thread, index):
+    """The iexport record of the message at INDEX of THREAD."""
+    fp = thread.open(index)
+    try:
+        parts = MessageParts(fp)
+        text = []
+        attachments = []
+        for part, lines in parts:
+            ctype = part.get_content_type()
+            if ctype == 'text/plain':
+                data = ''.join(_decode_lines(lines, part['Content-Transfer-Encoding']))
+                text.append(_export_text(data, part.get_content_charset()))
+            else:
+                blob, part = _blob_reference(part, lines)
+                filename = part.get_filename()
+                attachments.append({ 'number': len(attachments) + 1, 'type': part.get_content_type(),
+                                     'filename': filename and _export_text(filename),
+                                     'size': _part_size(part, lines), 'blob': blob })
+        headers = parts.headers
+    finally:
+        fp.close()
+    return { 'issue': issue_id, 'comment': index,
+             'id': headers['Message-Id'], 'parent': headers['In-Reply-To'],
+             'from': headers['From'] and _export_text(headers['From']),
+             'subject': headers['Subject'] and _export_text(headers['Subject']),
+             'date': thread.date(index),
+             'headers': [[_export_text(k), _export_text(v)] for k,v in headers.items()],
+             'body': u'\n'.join(text), 'attachments': attachments }
+
+def _filter_properties(ui, issues_path, name):
+    """Return the properties of the filter NAME, defined in ISSUES_PATH/.filter*"""
+    import ConfigParser
+    filters = glob.glob(os.path.join(issues_path, filter_prefix + '*'))
+    config = ConfigParser.SafeConfigParser()
+    config.read(filters)
+    if not config.has_section(name):
+        ui.write('No filter %s defined\n' % name)
+        return []
+    return config.items(name)
 
 def _get_properties(property_list):
-    return [p.split('=') for p in property_list]
+    return [p.split('=', 1) for p in property_list]
 
-def _write_message(ui, message, index = 0, skip = None):
+def _write_message(ui, fp, index = 0, skip = None, properties = None):
+    """Write the message in the file FP, a part at a time."""
     if index: ui.write("Comment: %d\n" % index)
     if ui.verbose:
-        _show_text(ui, message.as_string().strip(), skip)
+        _show_lines(ui, fp, skip)
     else:
+        parts = MessageParts(fp)
+        message = parts.headers
         if 'From' in message: ui.write('From: %s\n' % message['From'])
         if 'Date' in message: ui.write('Date: %s\n' % message['Date'])
         if 'Subject' in message: ui.write('Subject: %s\n' % message['Subject'])
-        if 'State' in message: ui.write('State: %s\n' % message['State'])
+        properties = properties or message
+        if 'State' in properties: ui.write('State: %s\n' % properties['State'])
         counter = 1
-        for part in message.walk():
+        for part, lines in parts:
             ctype = part.get_content_type()
-            maintype, subtype = ctype.split('/', 1)
-            if maintype == 'multipart': continue
             if ctype == 'text/plain':
                 ui.write('\n')
-                _show_text(ui, part.get_payload().strip(), skip)
+                _show_lines(ui, lines, skip)
             else:
+                blob, part = _blob_reference(part, lines)
+                ctype = part.get_content_type()
                 filename = part.get_filename()
-                ui.write('\n' + '%d: Attachment [%s, %s]: %s' % (counter, ctype, _humanreadable(len(part.get_payload())), filename) + '\n')
+                ui.write('\n' + '%d: Attachment [%s, %s]: %s' % (counter, ctype, _humanreadable(_part_size(part, lines)), filename) + '\n')
                 counter += 1
 
-def _show_text(ui, text, skip = None):
-    for line in text.splitlines():
-        if not skip or not line.startswith(skip):
-            ui.write(line + '\n')
+def _show_lines(ui, lines, skip = None):
+    """Write the text made of LINES, which are read one at a time, stripped
+    as text.strip() would, and without the lines that start with SKIP."""
+    held = None                         # the last line, stripped once we know it's the last
+    blank = []                          # whitespace lines after it
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            blank.append(line)
+            continue
+        if held is None:
+            line = line.lstrip()
+        else:
+            for l in [held] + blank:
+                _show_line(ui, l, skip)
+        held = line
+        blank = []
+    if held is not None:
+        _show_line(ui, held.rstrip(), skip)
     ui.write('\n')
 
-def _show_mbox(ui, mbox, comment, **opts):
+def _show_line(ui, line, skip):
+    if not skip or not line.startswith(skip):
+        ui.write(line + '\n')
+
+def _show_messages(ui, thread, indexes, **opts):
+    """Output the messages of THREAD at INDEXES in full, one at a time."""
+    ui.write('='*70 + '\n')
+    for i in indexes:
+        fp = thread.open(i)
+        try:
+            _write_message(ui, fp, i, skip = ('skip' in opts) and opts['skip'],
+                           properties = not i and thread.properties() or None)
+        finally:
+            fp.close()
+        ui.write('-'*70 + '\n')
+
+def _show_mbox(ui, thread, comment, **opts):
     # Output the issue (or comment)
-    if comment >= len(mbox):
+    if comment >= len(thread):
         comment = 0
         ui.warn('Comment out of range, showing the issue itself\n')
-    keys = _order_keys_date(mbox)
-    root = keys[0]
-    msg = mbox[keys[comment]]
+    fp = thread.open(comment)
     ui.write('='*70 + '\n')
     if comment:
-        ui.write('Subject: %s\n' % mbox[root]['Subject'])
-        ui.write('State: %s\n' % mbox[root]['State'])
+        root_msg = thread.properties()
+        ui.write('Subject: %s\n' % root_msg['Subject'])
+        ui.write('State: %s\n' % root_msg['State'])
         ui.write('-'*70 + '\n')
-    _write_message(ui, msg, comment, skip = ('skip' in opts) and opts['skip'])
+    try:
+        _write_message(ui, fp, comment, skip = ('skip' in opts) and opts['skip'],
+                       properties = not comment and thread.properties() or None)
+    finally:
+        fp.close()
     ui.write('-'*70 + '\n')
 
-    # Read the mailbox into the messages and children dictionaries
-    messages = {}
-    children = {}
-    i = 0
-    for k in keys:
-        m = mbox[k]
-        messages[m['Message-Id']] = (i,m)
-        children.setdefault(m['In-Reply-To'], []).append(m['Message-Id'])
-        i += 1
-    children[None] = []                # Safeguard against infinte loop on empty Message-Id
-
     # Iterate over children
-    id = msg['Message-Id']
-    id_stack = (id in children and map(lambda x: (x, 1), reversed(children[id]))) or []
-    if not id_stack: return
-    ui.write('Comments:\n')
-    while id_stack:
-        id,offset = id_stack.pop()
-        id_stack += (id in children and map(lambda x: (x, offset+1), reversed(children[id]))) or []
-        index, msg = messages[id]
-        ui.write('  '*offset + '%d: [%s] %s\n' % (index, shortuser(msg['From']), msg['Subject']))
-    ui.write('-'*70 + '\n')
+    replied = False
+    for index, depth in thread.replies(comment):
+        if not replied:
+            ui.write('Comments:\n')
+            replied = True
+        msg = thread.headers(index)
+        ui.write('  '*depth + '%d: [%s] %s\n' % (index, shortuser(msg['From']), msg['Subject']))
+    if replied: ui.write('-'*70 + '\n')
+
+class IssueQuery(object):
+    """Selection of issues for ilist; must stay picklable for the workers."""
+
+    def __init__(self, properties, show_all, date, order, list_properties, formats, ids = None):
+        self.conditions = [PropertyCondition(p, v) for p,v in properties]
+        self.show_all = show_all
+        self.date = date
+        self.order = order
+        self.list_properties = list_properties
+        self.formats = formats
+        self.ids = ids
+        self._date_match = date and matchdate(date)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_date_match']                # closures don't pickle
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._date_match = self.date and matchdate(self.date)
+
+    def __call__(self, issue_id, entry):
+        root = self.match(issue_id, entry)
+        if root is None: return None
+        return self.summary(issue_id, entry, root)
+
+    def match(self, issue_id, entry):
+        """Return the root headers of the issue if it matches, or None."""
+        if not entry['root']: return None
+        root = Headers(entry['headers'])
+        property_match = all(c(root, entry) for c in self.conditions)
+
+        if not self.show_all and (not self.conditions or not property_match) and (self.conditions or root['State'].upper() in [f.upper() for f in state['resolved']]): return None
+        if self.date and not self._date_match(entry['first'][0]): return None
+        return root
+
+    def summary(self, issue_id, entry, root):
+        """Return what the query returns for a matching issue."""
+        if self.list_properties:
+            return [(lp, root[lp]) for lp in self.list_properties if lp in root]
+
+        return (self.formats(entry['headers'], issue_id, entry['len'],
+                             self.ids and self.ids.shortest(issue_id)),
+                self.sort_key(issue_id, entry))
+
+    def sort_key(self, issue_id, entry):
+        """The key the issues are listed by, the largest first."""
+        return (tuple((self.order == 'latest' and entry['latest']) or entry['first']), issue_id)
+
+    def candidates(self, index):
+        """Return the set of ids of the issues that may match, looked up in the
+        secondary indexes of INDEX, or None if every issue has to be checked."""
+        if self.show_all: return None
+        result = None
+        for c in self.conditions:
+            ids = c.candidates(index)
+            if ids is None: continue
+            if result is None:
+                result = ids
+            else:
+                result &= ids
+        return result
+
+class PropertyCondition(object):
+    """Condition on a property of the root message, as in -p NAME=VALUE."""
+
+    def __init__(self, name, value):
+        self.negate = self.regex = False
+        if name.endswith('~'):
+            self.regex, name = True, name[:-1]
+        if name.endswith('!'):
+            self.negate, name = True, name[:-1]
+        self.name = name.strip()
+        self.value = value.strip()
+        self.date = self.name.lower() == 'date'
+        self._compile()
+
+    def _compile(self):
+        if self.date:
+            self._match = matchdate(self.value)
+        elif self.regex:
+            self._match = re.compile(self.value).search
+        else:
+            self.values = self.value and self.value.split('|') or []
+            self.patterns = [v for v in self.values if any(c in v for c in '*?[')]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_match', None)               # closures don't pickle
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def __call__(self, root, entry):
+        if self.date:
+            result = self._match(entry['first'][0])
+        elif self.regex:
+            value = root[self.name]
+            result = value is not None and self._match(value) is not None
+        elif not self.values:
+            result = self.name not in root
+        else:
+            value = root[self.name]
+            result = value is not None and \
+                     (value in self.values or any(fnmatch.fnmatchcase(value, p) for p in self.patterns))
+        return result != self.negate
+
+    def candidates(self, index):
+        """Return the ids of the issues whose property has one of the (literal)
+        values, or None if the condition can't be looked up in an index."""
+        if self.date or self.regex or self.negate or not self.values or self.patterns:
+            return None
+        values = index.lookup(self.name)
+        result = set()
+        for v in self.values:
+            result |= values.get(v, set())
+        return result
+
+def _scan_issue(args):
+    issue, issue_id, query = args
+    return query(issue_id, _index_entry(issue))
+
+def _scan_issue_profiled(args):
+    """_scan_issue, also returning the time spent reading, matching and
+    formatting the issue, and the bytes read."""
+    issue, issue_id, query = args
+    read = _read_bytes[0]
+    start = time.time()
+    entry = _index_entry(issue)
+    stats = { 'read': time.time() - start, 'bytes': _read_bytes[0] - read, 'messages': entry.get('len', 0) }
+    return _query_issue(query, issue_id, entry, None, stats), stats
+
+def _query_issue(query, issue_id, entry, profile, stats = None):
+    """query(ISSUE_ID, ENTRY), adding the time spent matching and formatting
+    the issue to STATS, or to the issue's statistics in PROFILE."""
+    if not profile and stats is None:
+        return query(issue_id, entry)
+    if stats is None: stats = {}
+    start = time.time()
+    root = query.match(issue_id, entry)
+    matched = time.time()
+    result = None
+    if root is not None: result = query.summary(issue_id, entry, root)
+    stats['match'] = matched - start
+    stats['format'] = time.time() - matched
+    if profile: profile.issue(issue_id, **stats)
+    return result
+
+def _jobs(ui, opts):
+    return int(opts.get('jobs') or ui.config('artemis', 'jobs', default = 0) or 0)
+
+def _pool(jobs, items):
+    import multiprocessing
+    return multiprocessing.Pool(min(jobs, len(items)), _pool_worker)
+
+def _pool_worker():
+    # The workers inherit Mercurial's SIGTERM handler, which would print a
+    # traceback when the pool is terminated; an interrupt is left to the
+    # parent, which terminates the pool.
+    import signal
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _map(jobs, func, items):
+    """map(FUNC, ITEMS), spread over JOBS worker processes if JOBS > 1."""
+    if jobs <= 1 or len(items) < 2:
+        return map(func, items)
+
+    pool = _pool(jobs, items)
+    try:
+        result = pool.map(func, items, chunksize = max(1, len(items) // (4*jobs)))
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return result
+
+def _imap(jobs, func, items):
+    """Like _map(), but yield the results as they come (in no particular
+    order if JOBS > 1)."""
+    if jobs <= 1 or len(items) < 2:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = _pool(jobs, items)
+    try:
+        for result in pool.imap_unordered(func, items, chunksize = max(1, len(items) // (16*jobs))):
+            yield result
+    except:                             # including GeneratorExit, if the caller stops early
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+def _profiling(ui, opts):
+    """Whether profiling is on (--timing or [artemis] profile)."""
+    return opts.get('timing') or _config_bool(ui.config('artemis', 'profile', default = None))
+
+def _profile(ui, opts):
+    """Return a Profile if profiling is on, otherwise None."""
+    if not _profiling(ui, opts): return None
+    return Profile(ui.config('artemis', 'profile-output', default = None),
+                   int(ui.config('artemis', 'profile-issues', default = 10)))
+
+def _config_bool(value):
+    return str(value).lower() in ('1', 'yes', 'true', 'on')
+
+def _phase(profile, name):
+    """Context that times the phase NAME in PROFILE (which may be None)."""
+    if profile: return profile.phase(name)
+    return _no_phase()
+
+@contextlib.contextmanager
+def _no_phase():
+    yield
+
+_read_bytes = [0]       # bytes of message files (and caches) read by this process
+
+class Profile(object):
+    """Timings of a command's phases and issues, for --timing."""
+
+    def __init__(self, output = None, slowest = 10):
+        self.output = output
+        self.slowest = slowest
+        self.phases = []                # [name, seconds, calls, bytes], in order
+        self.issues = {}                # issue id -> {'read', 'match', 'format', 'bytes', 'messages'}
+        self.start = time.time()
+        self.profiler = None
+        if output and not output.endswith('.json'):
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start, read = time.time(), _read_bytes[0]
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start, _read_bytes[0] - read)
+
+    def add(self, name, seconds, bytes = 0, calls = 1):
+        for p in self.phases:
+            if p[0] == name:
+                p[1] += seconds; p[2] += calls; p[3] += bytes
+                return
+        self.phases.append([name, seconds, calls, bytes])
+
+    def issue(self, issue_id, **stats):
+        totals = self.issues.setdefault(issue_id, {})
+        for k, v in stats.iteritems():
+            totals[k] = totals.get(k, 0) + v
+
+    def slowest_issues(self):
+        total = lambda stats: stats.get('read', 0) + stats.get('match', 0) + stats.get('format', 0)
+        return sorted(self.issues.iteritems(), key = lambda (i, stats): -total(stats))[:self.slowest]
+
+    def finish(self, ui):
+        if self.profiler: self.profiler.disable()
+        total = time.time() - self.start
+
+        # Per-issue work, summed (over all the worker processes)
+        for name in ('read', 'match', 'format'):
+            times = [stats[name] for stats in self.issues.itervalues() if name in stats]
+            if times: self.add('  issue ' + name, sum(times), calls = len(times),
+                               bytes = name == 'read' and sum(s.get('bytes', 0) for s in self.issues.itervalues()) or 0)
+
+        ui.write_err('%-16s %10s %8s %12s\n' % ('phase', 'ms', 'calls', 'bytes'))
+        for name, seconds, calls, bytes in self.phases:
+            ui.write_err('%-16s %10.1f %8d %12d\n' % (name, seconds * 1000, calls, bytes))
+        ui.write_err('%-16s %10.1f\n' % ('total', total * 1000))
+
+        slowest = self.slowest_issues()
+        if slowest:
+            ui.write_err('\n%-16s %10s %8s %8s %8s %8s %12s\n' %
+                         ('slowest issues', 'ms', 'read', 'match', 'format', 'messages', 'bytes'))
+            for issue_id, stats in slowest:
+                times = [stats.get(k, 0) * 1000 for k in ('read', 'match', 'format')]
+                ui.write_err('%-16s %10.1f %8.1f %8.1f %8.1f %8d %12d\n' %
+                             tuple([issue_id, sum(times)] + times + [stats.get('messages', 0), stats.get('bytes', 0)]))
+
+        if self.profiler:
+            self.profiler.dump_stats(self.output)
+        elif self.output:
+            fp = open(self.output, 'w')
+            json.dump({ 'total': total,
+                        'phases': [dict(zip(('name', 'seconds', 'calls', 'bytes'), p)) for p in self.phases],
+                        'slowest': [dict(stats, id = issue_id) for issue_id, stats in slowest] },
+                      fp, indent = 1)
+            fp.close()
+
+def _week(t):
+    import datetime
+    year, week, day = datetime.date(*t[:3]).isocalendar()
+    return '%d-W%02d' % (year, week)
+
+# bucket -> function of the time.struct_time of a date
+_stats_buckets = { 'year':  lambda t: time.strftime('%Y', t),
+                   'month': lambda t: time.strftime('%Y-%m', t),
+                   'week':  _week,
+                   'day':   lambda t: time.strftime('%Y-%m-%d', t) }
+
+class IssueStats(object):
+    """Statistics of istats, accumulated an index entry at a time."""
+
+    columns = ['issues', 'replies', 'age p50', 'age p90', 'age max']
+
+    def __init__(self, group, bucket = None, latest = False):
+        self.group = group
+        self.bucket = bucket
+        self.latest = latest
+        self.now = time.time()
+        self.groups = {}                # key -> [issues, replies, [ages in days]]
+
+    def add(self, entry):
+        key = tuple(_entry_header(entry, name) for name in self.group)
+        date = self.latest and entry['latest'] or entry['first']
+        if self.bucket:
+            key += (_stats_buckets[self.bucket](time.gmtime(date[0] - date[1])),)   # in the zone of the message
+        stats = self.groups.setdefault(key, [0, 0, []])
+        stats[0] += 1
+        stats[1] += entry['len'] - 1
+        stats[2].append((self.now - date[0]) / 86400.)
+
+    def _row(self, issues, replies, ages):
+        ages.sort()
+        def percentile(q):              # nearest rank
+            return ages and round(ages[max(0, int(-(-q * len(ages) // 1)) - 1)], 1) or 0
+        return [issues, replies, percentile(.5), percentile(.9), percentile(1)]
+
+    def _total(self):
+        issues = sum(s[0] for s in self.groups.itervalues())
+        replies = sum(s[1] for s in self.groups.itervalues())
+        return self._row(issues, replies, [a for s in self.groups.itervalues() for a in s[2]])
+
+    def _names(self):
+        return self.group + (self.bucket and [self.bucket] or [])
+
+    def report(self):
+        """The statistics, as a dictionary (for JSON); ages are in days."""
+        def record(key, row):
+            record = dict(zip(['issues', 'replies'], row[:2]))
+            record['age'] = dict(zip(['p50', 'p90', 'max'], row[2:]))
+            if key is not None: record['group'] = dict(zip(self._names(), key))
+            return record
+        return { 'groups': [record(key, self._row(*self.groups[key])) for key in sorted(self.groups)],
+                 'total': record(None, self._total()) }
+
+    def write(self, ui):
+        """Write the statistics as a table; ages are in days."""
+        if not self._names():
+            rows = [self._total()]
+        else:
+            rows = [['(none)' if v is None else v for v in key] + self._row(*self.groups[key]) for key in sorted(self.groups)]
+            rows.append(['total'] + [''] * (len(self._names()) - 1) + self._total())
+        header = self._names() + self.columns
+        widths = [max(len(str(r[i])) for r in rows + [header]) for i in xrange(len(header))]
+        for n, row in enumerate([header] + rows):
+            cells = []
+            for i, value in enumerate(row):
+                if i < len(self._names()):
+                    cells.append(str(value).ljust(widths[i]))
+                else:
+                    cells.append(str(value).rjust(widths[i]))
+            ui.write('  '.join(cells).rstrip() + '\n')
+
+class IssueIds(object):
+    """Sorted issue ids in ISSUES_PATH, for prefix lookups, cached in .ids."""
+
+    def __init__(self, issues_path, ids = None):
+        if ids is not None:     # issues not in a directory (at a revision): nothing to cache
+            self.path = self.stamp = None
+            self.ids = sorted(ids)
+            return
+
+        self.path = os.path.join(issues_path, ids_file)
+        self.stamp = os.stat(issues_path).st_mtime
+        self.ids = None
+
+        cached = None
+        width = 0                       # of the time in the file
+        try:
+            fp = open(self.path)
+            try:
+                line = fp.readline()
+                width = len(line) - 1
+                stamp = float(line)
+                cached = fp.read().split()
+            finally:
+                fp.close()
+            if stamp == self.stamp:
+                self.ids = cached
+        except (IOError, ValueError):
+            pass
+
+        if self.ids is None:
+            self.ids = sorted(i for i in os.listdir(issues_path) if not i.startswith('.'))
+            if os.path.exists(os.path.join(issues_path, index_file)) and int(self.stamp) < int(time.time()):
+                if self.ids != cached or not self._restamp(width):
+                    self.save()
+
+    def _stamp_line(self):
+        return ('%r' % self.stamp).ljust(stamp_width) + '\n'
+
+    def _restamp(self, width):
+        """Overwrite the time in the file, if it fits in WIDTH; return whether it did."""
+        line = self._stamp_line()
+        if len(line) - 1 != width: return False
+        try:
+            fp = open(self.path, 'r+b')
+            try:
+                fp.write(line)
+            finally:
+                fp.close()
+        except IOError:
+            return False
+        return True
+
+    def save(self):
+        tmp = None
+        try:
+            fp, tmp = _temp_file(self.path)
+            try:
+                fp.write(self._stamp_line())
+                fp.write(''.join(i + '\n' for i in self.ids))
+            finally:
+                fp.close()
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            if tmp and os.path.exists(tmp): os.remove(tmp)
+
+    def lookup(self, prefix):
+        """Return the ids that start with PREFIX."""
+        result = []
+        for i in xrange(bisect.bisect_left(self.ids, prefix), len(self.ids)):
+            if not self.ids[i].startswith(prefix): break
+            result.append(self.ids[i])
+        return result
+
+    def shortest(self, id):
+        """Return the shortest prefix of ID that no other issue id starts with."""
+        i = bisect.bisect_left(self.ids, id)
+        length = 1
+        for j in (i-1, (i < len(self.ids) and self.ids[i] == id) and i+1 or i):
+            if 0 <= j < len(self.ids):
+                other = self.ids[j]
+                common = 0
+                while common < min(len(id), len(other)) and id[common] == other[common]:
+                    common += 1
+                length = max(length, common + 1)
+        return id[:length]
+
+_issue_ids_cache = {}
+def _issue_ids(issues_path):
+    """Return the IssueIds of ISSUES_PATH, reusing the one from an earlier
+    call if the directory hasn't changed since."""
+    ids = _issue_ids_cache.get(issues_path)
+    if ids and _server and _server.issues_path == issues_path and _server.watcher:
+        return ids                      # the server's watcher drops it when issues come or go
+    if not ids or ids.stamp != os.stat(issues_path).st_mtime:
+        ids = _issue_ids_cache[issues_path] = IssueIds(issues_path)
+    return ids
+
+class Headers(object):
+    """Case-insensitive, read-only view of a list of (name, value) headers."""
+
+    def __init__(self, headers):
+        self._headers = headers
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def get(self, name, failobj = None):
+        name = name.lower()
+        for k,v in self._headers:
+            if k.lower() == name: return v
+        return failobj
+
+    def __contains__(self, name):
+        name = name.lower()
+        return any(k.lower() == name for k,v in self._headers)
+
+    def keys(self):
+        return [k for k,v in self._headers]
+
+    def items(self):
+        return [(k,v) for k,v in self._headers]
+
+def _index_entry(issue):
+    """Compute the index entry of the issue stored in the maildir ISSUE."""
+    return _thread_entry(IssueThread(_open_issue(issue)))
+
+def _thread_entry(thread):
+    """Compute the index entry of the issue with the messages THREAD."""
+    entry = { 'root': thread.root, 'keys': sorted(thread.keys) }
+    if thread.root:
+        entry['headers'] = [list(h) for h in thread.properties().items()]
+        entry['len']     = len(thread)
+        entry['first']   = thread.date(0)
+        entry['latest']  = thread.date(-1)
+    return entry
+
+def _index_entry_profiled(issue):
+    """_index_entry, also returning the time spent and the bytes read."""
+    read = _read_bytes[0]
+    start = time.time()
+    entry = _index_entry(issue)
+    return entry, { 'read': time.time() - start, 'bytes': _read_bytes[0] - read,
+                    'messages': entry.get('len', 0) }
+
+def _issue_stamp(issue):
+    """Modification times of the subdirectories of ISSUE that Maildir reads,
+    or of ISSUE itself if it's a pack."""
+    if os.path.isfile(issue): return [os.path.getmtime(issue)]
+    stamp = []
+    for d in maildir_dirs[:2]:          # tmp is never read
+        try:
+            stamp.append(os.stat(os.path.join(issue, d)).st_mtime)
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+def _entry_header(entry, name):
+    """Value of the root header NAME (in lower case) of an index entry, as
+    the message itself would return it: the first one, or None."""
+    if not entry['root']: return None
+    for k,v in entry['headers']:
+        if k.lower() == name: return v
+    return None
+
+def _trusted_stamp(stamp):
+    """Return STAMP, or None if it can't be relied upon: a directory modified
+    within the current second may change again without its mtime changing."""
+    now = int(time.time())
+    if any(m is None or int(m) >= now for m in stamp):
+        return None
+    return stamp
+
+def _json_str(obj):
+    # json.load returns unicode; strings are stored as latin-1 to get the original bytes back
+    if isinstance(obj, unicode):
+        return obj.encode('latin-1')
+    elif isinstance(obj, list):
+        return [_json_str(o) for o in obj]
+    elif isinstance(obj, dict):
+        return dict((_json_str(k), _json_str(v)) for k,v in obj.iteritems())
+    return obj
+
+def _open_index(issues_path):
+    """Return the IssueIndex of ISSUES_PATH, or None if the index was never built.
+    Within iserve, return the index it keeps in memory."""
+    if _server and _server.issues_path == issues_path: return _server.index
+    if not os.path.exists(os.path.join(issues_path, index_file)): return None
+    return IssueIndex(issues_path)
+
+class IssueIndex(object):
+    """Cache of what ilist needs about each issue, in ISSUES_PATH/.index."""
+
+    def __init__(self, issues_path, load = True):
+        self.path = os.path.join(issues_path, index_file)
+        self.entries = {}
+        self.secondary = {}         # lower-case header -> {value: set of issue ids}
+        self.changed = not load
+        if load: self.load()
+
+    def load(self):
+        try:
+            fp = open(self.path)
+            try:
+                data = json.load(fp)
+                _read_bytes[0] += fp.tell()
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            self.changed = True
+            return
+        if data.get('version') != index_version:
+            self.changed = True
+            return
+        self.entries = _json_str(data['issues'])
+        for entry in self.entries.itervalues():
+            if entry['root']:
+                entry['first']  = tuple(entry['first'])
+                entry['latest'] = tuple(entry['latest'])
+        for name, values in _json_str(data.get('secondary', {})).iteritems():
+            self.secondary[name] = dict((v, set(ids)) for v, ids in values.iteritems())
+
+    def get(self, issue, issue_id):
+        """Return the entry for maildir ISSUE, refreshing it if the maildir changed."""
+        return self.update([issue], [issue_id])[0]
+
+    def update(self, issues, issue_ids, jobs = 0, profile = None, changed = None):
+        """Return the entries for ISSUES, refreshing the ones that changed
+        (only those in CHANGED, if given)."""
+        if changed is None:
+            stamps = [_issue_stamp(issue) for issue in issues]
+            stale = [n for n,(issue_id,stamp) in enumerate(zip(issue_ids, stamps))
+                       if issue_id not in self.entries or
+                          self.entries[issue_id]['stamp'] is None or
+                          self.entries[issue_id]['stamp'] != stamp]
+        else:
+            stale = [n for n,issue_id in enumerate(issue_ids)
+                       if issue_id not in self.entries or issue_id in changed]
+            stamps = dict((n, _issue_stamp(issues[n])) for n in stale)
+
+        if profile:
+            entries = []
+            for n, (entry, stats) in zip(stale, _map(jobs, _index_entry_profiled, [issues[n] for n in stale])):
+                profile.issue(issue_ids[n], **stats)
+                entries.append(entry)
+        else:
+            entries = _map(jobs, _index_entry, [issues[n] for n in stale])
+
+        for n, entry in zip(stale, entries):
+            entry['stamp'] = _trusted_stamp(stamps[n])
+            self._unindex(issue_ids[n])
+            self.entries[issue_ids[n]] = entry
+            self._reindex(issue_ids[n])
+            self.changed = True
+
+        return [self.entries[issue_id] for issue_id in issue_ids]
+
+    def prune(self, issue_ids):
+        """Drop the entries of issues not in ISSUE_IDS."""
+        for issue_id in set(self.entries) - set(issue_ids):
+            self._unindex(issue_id)
+            del self.entries[issue_id]
+            self.changed = True
+
+    def lookup(self, name):
+        """Return the secondary index of the root header NAME, {value: set of
+        issue ids}. It's built on first use, and then kept up to date."""
+        name = name.lower()
+        if name not in self.secondary:
+            values = self.secondary[name] = {}
+            for issue_id, entry in self.entries.iteritems():
+                value = _entry_header(entry, name)
+                if value is not None: values.setdefault(value, set()).add(issue_id)
+            self.changed = True
+        return self.secondary[name]
+
+    def _unindex(self, issue_id):
+        if issue_id not in self.entries: return
+        for name, values in self.secondary.iteritems():
+            value = _entry_header(self.entries[issue_id], name)
+            if value is None: continue
+            values[value].discard(issue_id)
+            if not values[value]: del values[value]
+
+    def _reindex(self, issue_id):
+        for name, values in self.secondary.iteritems():
+            value = _entry_header(self.entries[issue_id], name)
+            if value is not None: values.setdefault(value, set()).add(issue_id)
+
+    def save(self):
+        if not self.changed: return
+        tmp = None
+        try:
+            fp, tmp = _temp_file(self.path)
+            try:
+                secondary = dict((name, dict((v, sorted(ids)) for v, ids in values.iteritems()))
+                                 for name, values in self.secondary.iteritems())
+                json.dump({ 'version': index_version, 'issues': self.entries, 'secondary': secondary },
+                          fp, encoding = 'latin-1')
+            finally:
+                fp.close()
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            if tmp and os.path.exists(tmp): os.remove(tmp)
+            return          # read-only checkout; the index is only a cache
+        self.changed = False
+
+_word_re = re.compile(r'\b[a-z0-9_]{2,40}\b')
+
+def _words(text):
+    return _word_re.findall(text.lower())
+
+def _issue_words(issue):
+    """Return {key: {word: count}} for the subjects and the text/plain parts
+    of the messages in the issue ISSUE."""
+    mbox = _open_issue(issue)
+    result = {}
+    for key in mbox.iterkeys():
+        fp = mbox.get_file(key)
+        parts = MessageParts(fp)
+        words = _words(parts.headers['Subject'] or '')
+        for part, lines in parts:
+            if part.get_content_type() == 'text/plain':
+                words += _words(''.join(_decode_lines(lines, part['Content-Transfer-Encoding'])))
+        fp.close()
+        counts = result[key] = {}
+        for w in words:
+            counts[w] = counts.get(w, 0) + 1
+    return result
+
+class SearchIndex(object):
+    """Inverted index of the words in the messages, in ISSUES_PATH/.search."""
+
+    def __init__(self, issues_path):
+        self.path = os.path.join(issues_path, search_file)
+        self.issues = {}            # issue id -> (stamp, number of messages)
+        self.documents = 0
+        self.offset = 0             # start of the word lines
+        self._data = None           # the index, if it couldn't be saved
+        try:
+            fp = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            header = fp.readline().split()
+            if header[:2] != ['artemis-search', str(search_version)]: return
+            count, self.documents = int(header[2]), int(header[3])
+            for n in xrange(count):
+                issue_id, stamp, messages = fp.readline().rstrip('\n').split('\t')
+                self.issues[issue_id] = (json.loads(stamp), int(messages))
+            self.offset = fp.tell()
+        except (IndexError, ValueError):
+            self.issues, self.documents, self.offset = {}, 0, 0
+        finally:
+            fp.close()
+
+    def update(self, issues, issue_ids, jobs = 0):
+        """Reindex the maildirs ISSUES that changed since the last update, and
+        drop the issues not among ISSUE_IDS."""
+        stamps = [_issue_stamp(issue) for issue in issues]
+        stale = [n for n,(issue_id,stamp) in enumerate(zip(issue_ids, stamps))
+                   if issue_id not in self.issues or
+                      self.issues[issue_id][0] is None or
+                      self.issues[issue_id][0] != stamp]
+        removed = set(self.issues) - set(issue_ids)
+        if not stale and not removed and os.path.exists(self.path): return
+
+        # New postings of the stale issues
+        postings = {}
+        replaced = removed | set(issue_ids[n] for n in stale)
+        for issue_id in replaced:
+            if issue_id in self.issues:
+                self.documents -= self.issues[issue_id][1]
+                del self.issues[issue_id]
+        for n, words in zip(stale, _map(jobs, _issue_words, [issues[n] for n in stale])):
+            issue_id = issue_ids[n]
+            self.documents += len(words)
+            for key, counts in words.iteritems():
+                for w, c in counts.iteritems():
+                    postings.setdefault(w, []).append('%s/%s/%d' % (issue_id, key, c))
+            self.issues[issue_id] = (_trusted_stamp(stamps[n]), len(words))
+
+        # Merge them with the old word lines into a new file
+        try:
+            out, tmp = _temp_file(self.path, 'wb')
+        except (IOError, OSError):
+            import cStringIO            # read-only checkout; the index is only a cache
+            out, tmp = cStringIO.StringIO(), None
+        try:
+            out.write('artemis-search %d %d %d\n' % (search_version, len(self.issues), self.documents))
+            for issue_id in sorted(self.issues):
+                stamp, messages = self.issues[issue_id]
+                out.write('%s\t%s\t%d\n' % (issue_id, json.dumps(stamp), messages))
+            offset = out.tell()
+
+            new_words = sorted(postings)
+            i = 0
+            for word, old in self._word_lines():
+                while i < len(new_words) and new_words[i] < word:
+                    out.write('%s\t%s\n' % (new_words[i], ' '.join(postings[new_words[i]])))
+                    i += 1
+                kept = [p for p in old if p.split('/', 1)[0] not in replaced]
+                if i < len(new_words) and new_words[i] == word:
+                    kept += postings[word]
+                    i += 1
+                if kept:
+                    out.write('%s\t%s\n' % (word, ' '.join(kept)))
+            for w in new_words[i:]:
+                out.write('%s\t%s\n' % (w, ' '.join(postings[w])))
+            if tmp is None:
+                self._data = out.getvalue()
+            else:
+                out.close()
+                os.rename(tmp, self.path)
+        except:
+            out.close()
+            if tmp: os.remove(tmp)
+            raise
+        self.offset = offset
+
+    def _open(self):
+        if self._data is not None: return _string_file(self._data)
+        return open(self.path, 'rb')
+
+    def _word_lines(self):
+        if not self.offset: return
+        fp = self._open()
+        try:
+            fp.seek(self.offset)
+            for line in fp:
+                word, postings = line.rstrip('\n').split('\t')
+                yield word, postings.split()
+        finally:
+            fp.close()
 
-def _find_root_key(maildir):
-    for k,m in maildir.iteritems():
-        if 'in-reply-to' not in m:
-            return k
-
-def _order_keys_date(mbox):
-    keys = mbox.keys()
-    root = _find_root_key(mbox)
-    keys.sort(lambda k1,k2: -(k1 == root) or cmp(parsedate(mbox[k1]['date']), parsedate(mbox[k2]['date'])))
-    return keys
-
-def _find_mbox_date(mbox, root, order):
-    if order == 'latest':
-        keys = _order_keys_date(mbox)
-        msg = mbox[keys[-1]]
-    else:   # new
-        msg = mbox[root]
-    return parsedate(msg['date'])
+    def _postings(self, word):
+        """Return the postings of WORD, located by binary search."""
+        if not self.offset: return []
+        fp = self._open()
+        try:
+            fp.seek(0, 2)
+            lo, hi = self.offset, fp.tell()
+            start = lo
+            def line_at(pos):               # first complete line starting at or after pos
+                if pos > start:
+                    fp.seek(pos - 1)
+                    fp.readline()
+                else:
+                    fp.seek(start)
+                return fp.readline()
+            while lo < hi:
+                mid = (lo + hi) // 2
+                line = line_at(mid)
+                if line and line.split('\t', 1)[0] < word:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            line = line_at(lo)
+        finally:
+            fp.close()
+        w, _, postings = line.rstrip('\n').partition('\t')
+        if w != word: return []
+        return postings.split()
+
+    def search(self, text):
+        """Return {(issue id, message key): score} for the messages that contain
+        all the words of TEXT, scored by tf-idf."""
+        import math
+        hits = None
+        for w in set(_words(text)):
+            postings = self._postings(w)
+            idf = math.log(float(self.documents + 1) / (len(postings) or 1))
+            scores = {}
+            for p in postings:
+                issue_id, key, count = p.rsplit('/', 2)
+                scores[(issue_id, key)] = int(count) * idf
+            if hits is None:
+                hits = scores
+            else:
+                hits = dict((m, hits[m] + scores[m]) for m in hits if m in scores)
+        return hits or {}
+
+def _import_mbox(source):
+    import mailbox, email.parser
+    mbox = mailbox.mbox(source, create = False)
+    for key in mbox.iterkeys():
+        yield email.parser.HeaderParser().parsestr(mbox.get_string(key)), []
+
+def _import_maildir(source):
+    import mailbox, email.parser
+    for path, dirs, files in os.walk(source):
+        if 'cur' not in dirs and 'new' not in dirs: continue
+        dirs[:] = [d for d in dirs if d not in maildir_dirs]
+        mbox = mailbox.Maildir(path, factory = None, create = False)
+        for key in mbox.iterkeys():
+            yield email.parser.HeaderParser().parsestr(mbox.get_string(key)), []
+
+def _import_json(source):
+    """Messages from SOURCE with a JSON object per line (see the README)."""
+    import email.message
+    fp = open(source)
+    try:
+        for line in fp:
+            if not line.strip(): continue
+            record = _json_str(json.loads(line))
+            msg = email.message.Message()
+            headers = record.get('headers', [])
+            if isinstance(headers, dict): headers = headers.items()
+            for k,v in headers:
+                msg[k] = v
+            for k,h in (('from', 'From'), ('date', 'Date'), ('subject', 'Subject'), ('id', 'Message-Id')):
+                if k in record:
+                    del msg[h]
+                    msg[h] = record[k]
+            if record.get('parent'):
+                del msg['In-Reply-To']
+                msg['In-Reply-To'] = record['parent']
+                if 'References' not in msg: msg['References'] = record['parent']
+            msg.set_payload(record.get('body', ''))
+            yield msg, record.get('properties', {}).items()
+    finally:
+        fp.close()
+
+_import_readers = { 'mbox': _import_mbox, 'maildir': _import_maildir, 'json': _import_json }
+
+class IssueImporter(object):
+    """Adds a stream of messages to the issues in ISSUES_PATH, threaded by
+    In-Reply-To; the new files accumulate in PATHS."""
+
+    def __init__(self, issues_path, packed = False, append = False, blobs = None):
+        self.issues_path = issues_path
+        self.packed = packed
+        self.append = append
+        self.blobs = blobs
+        self.issues = {}                # Message-Id -> issue id
+        self.mboxes = {}                # issue id -> IssueMaildir or IssuePack
+        self.pending = {}               # Message-Id -> [(msg, properties)] waiting for it
+        self.properties = {}            # issue id -> [(property, value)]
+        self.tracker = None             # Message-Id -> issue id, for existing issues
+        self.new_issues = set()
+        self.existing_comments = 0
+        self.messages = 0
+        self.paths = []
+
+    def add(self, msg, properties = []):
+        if 'Message-Id' not in msg:
+            import socket
+            msg['Message-Id'] = '<%s-artemis@%s>' % (_random_id(), socket.gethostname())
+        parent = msg['In-Reply-To']
+        if not parent:
+            self._place(self._new_issue(), msg, properties)
+            return
+        issue_id = self.issues.get(parent) or self._tracker_issue(parent)
+        if issue_id:
+            self._place(issue_id, msg, properties)
+        else:
+            self.pending.setdefault(parent, []).append((msg, properties))
+
+    def finish(self):
+        """Write the messages whose parents never arrived, and the properties
+        of the existing issues, and close the issues."""
+        for parent in sorted(self.pending):
+            for msg, properties in self.pending.pop(parent, []):
+                del msg['In-Reply-To']
+                del msg['References']
+                self._place(self._new_issue(), msg, properties)
+
+        for issue_id, properties in self.properties.iteritems():
+            mbox = self.mboxes[issue_id]
+            mbox.set_headers(IssueThread(mbox).root, properties)
+
+        for mbox in self.mboxes.itervalues():
+            mbox.close()
+
+    def _new_issue(self):
+        issue_id = _random_id()
+        while os.path.exists(os.path.join(self.issues_path, issue_id)):
+            issue_id = _random_id()
+        self.new_issues.add(issue_id)
+        return issue_id
+
+    def _tracker_issue(self, message_id):
+        if self.tracker is None:
+            self.tracker = {}
+            for issue in glob.glob(os.path.join(self.issues_path, '*')):
+                mbox = _open_issue(issue)
+                for k in mbox.iterkeys():
+                    self.tracker[mbox.get_headers(k)['Message-Id']] = issue[len(self.issues_path)+1:]
+                mbox.close()
+        return self.tracker.get(message_id)
+
+    def _place(self, issue_id, msg, properties):
+        """Write MSG into ISSUE_ID, followed by the replies that waited for it."""
+        stack = [(msg, properties)]
+        while stack:
+            msg, properties = stack.pop()
+            self._write(issue_id, msg, properties)
+            stack.extend(reversed(self.pending.pop(msg['Message-Id'], [])))
+
+    def _write(self, issue_id, msg, properties):
+        if issue_id not in self.mboxes:
+            self.mboxes[issue_id] = _open_issue(os.path.join(self.issues_path, issue_id), self.packed)
+        mbox = self.mboxes[issue_id]
+
+        new = issue_id in self.new_issues
+        if new and 'In-Reply-To' not in msg:
+            if 'State' not in msg: msg['State'] = default_state
+            for property, value in properties:
+                del msg[property]
+                msg[property] = value
+        elif properties and self.append:
+            for property, value in properties:
+                msg.add_header(property_header, '%s=%s' % (property, value))
+        elif properties:
+            # The root is written already (or belongs to an existing issue)
+            self.properties.setdefault(issue_id, []).extend(properties)
+        if not new: self.existing_comments += 1
+
+        if self.blobs and msg.get_content_maintype() == 'multipart':
+            import email.parser
+            msg = email.parser.Parser().parsestr(_flatten(msg))
+            _store_attachments(msg, self.blobs)
+
+        key = mbox.add(msg)
+        self.messages += 1
+        if new or not isinstance(mbox, IssuePack):     # an existing pack is tracked already
+            self.paths.append(mbox.path(key))
+        self.issues[msg['Message-Id']] = issue_id
+
+class ResidentIndex(IssueIndex):
+    """The index iserve keeps in memory; only the issues in PENDING are
+    checked, while a watcher fills it in."""
+
+    def __init__(self, issues_path):
+        IssueIndex.__init__(self, issues_path)
+        self.persist = os.path.exists(self.path)
+        self.pending = None             # None: changes aren't being watched
+
+    def update(self, issues, issue_ids, jobs = 0, profile = None, changed = None):
+        if self.pending is None:
+            return IssueIndex.update(self, issues, issue_ids, jobs, profile)
+        entries = IssueIndex.update(self, issues, issue_ids, jobs, profile, self.pending)
+        self.pending -= set(issue_ids)
+        return entries
+
+    def save(self):
+        if self.persist: IssueIndex.save(self)
+
+_server = None          # the IssueServer running in this process
+
+class IssueServer(object):
+    """Server behind iserve, on the socket ISSUES_PATH/.socket."""
+
+    commands = ('ilist', 'ishow', 'isearch', 'istats')
+
+    def __init__(self, ui, repo, issues_path):
+        self.ui = ui
+        self.repo = repo
+        self.issues_path = issues_path
+        self.path = os.path.join(issues_path, socket_file)
+        self.listener = None
+        self.watcher = None
+        self.index = None
+        self.stopping = False
+
+    def bind(self):
+        """Listen on the socket; return False if another server already does."""
+        import socket
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                probe.close()
+                return False
+            except socket.error:
+                os.remove(self.path)        # left behind by a server that died
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(16)
+        return True
+
+    def serve(self):
+        global _server
+        import select
+        _server = self
+        try:
+            self.watcher = IssueWatcher(self.issues_path)
+        except (OSError, AttributeError), e:
+            self.ui.warn('Not watching the issues (%s), checking them on every request\n' % e)
+        self.index = ResidentIndex(self.issues_path)
+        issues = glob.glob(os.path.join(self.issues_path, '*'))
+        _create_all_missing_dirs(self.issues_path, issues)
+        issue_ids = [i[len(self.issues_path)+1:] for i in issues]
+        self.index.update(issues, issue_ids, _jobs(self.ui, {}))
+        self.index.prune(issue_ids)
+        self.index.save()
+        if self.watcher: self.index.pending = set()
+        self.ui.status('Serving %d issues on %s\n' % (len(issue_ids), self.path))
+
+        while not self.stopping:
+            waiting = [self.listener] + (self.watcher and [self.watcher] or [])
+            readable = select.select(waiting, [], [])[0]
+            if self.watcher in readable:
+                self.watch()
+            if self.listener in readable:
+                connection = self.listener.accept()[0]
+                try:
+                    self.handle(connection)
+                except (IOError, ValueError), e:       # the client went away, or sent garbage
+                    self.ui.warn('Dropped a request: %s\n' % e)
+                finally:
+                    connection.close()
+
+    def watch(self):
+        """Note the issues that changed, as the watcher reports them."""
+        if not self.watcher: return
+        self.watcher.process()
+        if self.watcher.failed:
+            self.ui.warn('Lost track of the issues, checking them on every request\n')
+            self.watcher.close()
+            self.watcher = None
+            self.index.pending = None
+            _issue_ids_cache.clear()
+            return
+        changed, everything, ids_changed = self.watcher.changes()
+        if everything:
+            changed = set(i for i in os.listdir(self.issues_path) if not i.startswith('.'))
+        self.index.pending |= changed
+        if ids_changed: _issue_ids_cache.clear()
+
+    def handle(self, connection):
+        fp = connection.makefile('rb')
+        line = fp.readline()
+        fp.close()
+        if not line: return             # just checking that the server is up
+        request = _json_str(json.loads(line))
+        out = connection.makefile('wb')
+        ui = ServerUI(out, request['config'], request['verbose'])
+        status = 0
+        try:
+            if request['command'] == 'stop':
+                self.stopping = True
+            elif request['command'] in self.commands:
+                self.watch()        # everything done before the request is in the queue by now
+                status = globals()[request['command']](ui, self.repo, *request['args'], **request['opts'])
+            else:
+                ui.warn('Unknown command %s\n' % request['command'])
+                status = 1
+        except Exception, e:
+            ui.warn('Server error: %s\n' % e)
+            status = 1
+        out.write('end %d\n' % (status or 0))
+        out.close()
+
+    def close(self):
+        global _server
+        if self.index: self.index.save()
+        if self.watcher: self.watcher.close()
+        if self.listener:
+            self.listener.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        _server = None
+
+class ServerUI(object):
+    """The ui of the commands iserve runs, which writes back to the client."""
+
+    def __init__(self, out, config, verbose):
+        self._out = out
+        self._config = config
+        self.verbose = verbose
+
+    def config(self, section, name, default = None):
+        if section != 'artemis': return default
+        return self._config.get(name, default)
+
+    def configitems(self, section):
+        if section != 'artemis': return []
+        return self._config.items()
+
+    def write(self, s):
+        self._out.write('out %d\n%s' % (len(s), s))
+
+    def write_err(self, s):
+        self._out.write('err %d\n%s' % (len(s), s))
+
+    status = write
+    warn = write_err
+
+    def note(self, s):
+        if self.verbose: self.write(s)
+
+def _connect(ui, repo):
+    """Return a socket connected to the iserve server of the repository, or
+    None if there is none (or this is it, or [artemis] serve is off)."""
+    if _server: return None
+    if not _config_bool(ui.config('artemis', 'serve', default = True)): return None
+    issues_dir = ui.config('artemis', 'issues', default = default_issues_dir)
+    path = os.path.join(repo.root, issues_dir, socket_file)
+    if not os.path.exists(path): return None
+    import socket
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.connect(path)
+    except socket.error:
+        server.close()
+        return None
+    return server
+
+_unanswered = object()
+
+def _remote(ui, server, command, args, opts):
+    """Run COMMAND in the iserve SERVER, and pass its output on to UI;
+    return _unanswered if it times out before answering."""
+    import socket
+    opts = dict((k, v) for k, v in opts.iteritems() if not callable(v))    # git-artemis' handler
+    request = { 'command': command, 'args': list(args), 'opts': opts,
+                'config': dict(ui.configitems('artemis')), 'verbose': bool(ui.verbose) }
+    server.settimeout(float(ui.config('artemis', 'serve-timeout', default = 10)))
+    fp = server.makefile('rb')
+    status = 1
+    answered = False
+    try:
+        server.sendall(json.dumps(request, encoding = 'latin-1') + '\n')
+        while True:
+            line = fp.readline()
+            if not line: break              # the server died
+            answered = True
+            kind, value = line.split()
+            if kind == 'end':
+                status = int(value)
+                break
+            data = fp.read(int(value))
+            if kind == 'out':
+                ui.write(data)
+            else:
+                ui.write_err(data)
+    except socket.timeout:
+        if not answered:
+            ui.warn('The server is not answering\n')
+            return _unanswered
+        ui.warn('The server stopped answering\n')
+    finally:
+        fp.close()
+        server.close()
+    return status or None
+
+class _Inotify(object):
+    """Just enough of inotify(7), through ctypes."""
+
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+    IN_NONBLOCK, IN_CLOEXEC = 0x800, 0x80000
+
+    def __init__(self):
+        import ctypes
+        self._libc = ctypes.CDLL(None, use_errno = True)
+        self._add_watch = self._libc.inotify_add_watch
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0: self._error()
+
+    def _error(self):
+        import ctypes
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0: self._error()
+        return wd
+
+    def read(self):
+        """Return the pending events, as (wd, mask, name)."""
+        import struct, errno
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN: break
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                offset += 16
+                events.append((wd, mask, data[offset:offset+length].rstrip('\0')))
+                offset += length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class IssueWatcher(object):
+    """Watch ISSUES_PATH with inotify for changes to the issues."""
+
+    dir_events  = _Inotify.IN_CREATE | _Inotify.IN_DELETE | _Inotify.IN_MOVED_FROM | _Inotify.IN_MOVED_TO
+    file_events = dir_events | _Inotify.IN_MODIFY | _Inotify.IN_CLOSE_WRITE | _Inotify.IN_ATTRIB
+
+    def __init__(self, issues_path):
+        self.issues_path = issues_path
+        self.inotify = _Inotify()
+        self.watches = {}               # wd -> (issue id, or None for ISSUES_PATH; subdirectory, or None)
+        self.changed = set()
+        self.everything = False
+        self.ids_changed = False
+        self.failed = False
+        self._watch(issues_path, None, None, self.file_events)      # packs are files
+        for issue_id in os.listdir(issues_path):
+            if not issue_id.startswith('.'): self._watch_issue(issue_id)
+
+    def fileno(self):
+        return self.inotify.fd
+
+    def _watch(self, path, issue_id, subdir, mask):
+        self.watches[self.inotify.add_watch(path, mask)] = (issue_id, subdir)
+
+    def _watch_issue(self, issue_id):
+        """Watch the maildir subdirectories of the issue, or the issue itself
+        until they are created."""
+        issue = os.path.join(self.issues_path, issue_id)
+        if not os.path.isdir(issue): return
+        missing = False
+        for d in maildir_dirs[:2]:
+            if os.path.isdir(os.path.join(issue, d)):
+                self._watch(os.path.join(issue, d), issue_id, d, self.file_events)
+            else:
+                missing = True
+        if missing: self._watch(issue, issue_id, None, self.dir_events)
+
+    def process(self):
+        """Read the pending events."""
+        try:
+            for wd, mask, name in self.inotify.read():
+                if mask & _Inotify.IN_Q_OVERFLOW:
+                    self.everything = self.ids_changed = True
+                    continue
+                if mask & _Inotify.IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if wd not in self.watches: continue
+                issue_id, subdir = self.watches[wd]
+                created = mask & _Inotify.IN_ISDIR and mask & (_Inotify.IN_CREATE | _Inotify.IN_MOVED_TO)
+                if issue_id is None:
+                    if name.startswith('.'): continue           # the caches, and the socket
+                    if mask & self.dir_events: self.ids_changed = True
+                    self.changed.add(name)                      # or a pack written to
+                    if created: self._watch_issue(name)
+                else:
+                    self.changed.add(issue_id)
+                    if subdir is None and created and name in maildir_dirs[:2]:
+                        self._watch(os.path.join(self.issues_path, issue_id, name), issue_id, name, self.file_events)
+        except OSError:
+            self.failed = True          # e.g., out of watches
+
+    def changes(self):
+        """Return (ids of the issues that changed, whether any issue may have
+        changed, whether issues were added or removed) since the last call."""
+        result = self.changed, self.everything, self.ids_changed
+        self.changed, self.everything, self.ids_changed = set(), False, False
+        return result
+
+    def close(self):
+        self.inotify.close()
+
+def _temp_file(path, mode = 'w'):
+    """Open a new file next to PATH, to be renamed over it; return it and its name."""
+    import tempfile
+    fd, tmp = tempfile.mkstemp(prefix = os.path.basename(path) + '-', dir = os.path.dirname(path))
+    return os.fdopen(fd, mode), tmp
 
 def _random_id():
+    import random
     return "%x" % random.randint(2**63, 2**64-1)
 
 def _create_missing_dirs(issues_path, issue):
+    if os.path.isfile(os.path.join(issues_path, issue)): return     # a pack
     for d in maildir_dirs:
         path = os.path.join(issues_path,issue,d)
         if not os.path.exists(path): os.mkdir(path)
@@ -426,10 +2361,22 @@ def _humanreadable(size):
     else:
         return '%dB' % size
 
-def _attach_files(msg, filenames):
+def _attach_files(fp, msg, filenames, blobs = None):
+    """Write MSG to FP with the files FILENAMES attached (or stored in BLOBS)."""
+    import mimetypes, shutil
+    from email.generator import Generator
+    from email.mime.base import MIMEBase
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    # The headers and the text, and then the attachments before the final boundary
     outer = MIMEMultipart()
     for k in msg.keys(): outer[k] = msg[k]
     outer.attach(MIMEText(msg.get_payload()))
+    head = _flatten(outer)
+    boundary = '--' + outer.get_boundary()
+    assert head.endswith('\n' + boundary + '--\n')
+    fp.write(head[:-3])
 
     for filename in filenames:
         ctype, encoding = mimetypes.guess_type(filename)
@@ -439,82 +2386,870 @@ def _attach_files(msg, filenames):
             ctype = 'application/octet-stream'
         maintype, subtype = ctype.split('/', 1)
         if maintype == 'text':
-            fp = open(filename)
             # Note: we should handle calculating the charset
-            attachment = MIMEText(fp.read(), _subtype=subtype)
-            fp.close()
-        elif maintype == 'image':
-            fp = open(filename, 'rb')
-            attachment = MIMEImage(fp.read(), _subtype=subtype)
-            fp.close()
-        elif maintype == 'audio':
-            fp = open(filename, 'rb')
-            attachment = MIMEAudio(fp.read(), _subtype=subtype)
-            fp.close()
+            attachment = MIMEText('', _subtype=subtype)
         else:
-            fp = open(filename, 'rb')
             attachment = MIMEBase(maintype, subtype)
-            attachment.set_payload(fp.read())
-            fp.close()
-            # Encode the payload using Base64
-            encoders.encode_base64(attachment)
-        # Set the filename parameter
+            attachment['Content-Transfer-Encoding'] = 'base64'
+        # Set the filename and the size parameters
         attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(filename))
-        outer.attach(attachment)
-    return outer
+        attachment.set_param('size', str(os.path.getsize(filename)), header='Content-Disposition')
+
+        if blobs:
+            # The part stands for the attachment, whose headers are its body
+            del attachment['Content-Transfer-Encoding']
+            reference = MIMEBase('message', 'external-body')
+            reference.set_param('access-type', blob_access_type)
+            reference.set_param('name', blobs.add(filename))
+            # (the generator won't write a message/* part without a message in it)
+            fp.write('\n' + ''.join('%s: %s\n' % h for h in reference.items()) + '\n')
+            fp.write(_flatten(attachment) + boundary)
+            continue
 
-def _read_formats(ui):
-    formats = []
-    global default_format
+        fp.write('\n' + _flatten(attachment))
+        src = open(filename, 'rb')
+        if maintype == 'text':
+            shutil.copyfileobj(src, fp, chunk_size)
+            fp.write('\n' + boundary)
+        else:
+            # The last line break of the encoded data starts the boundary
+            import binascii
+            for chunk in iter(lambda: src.read(chunk_size), ''):
+                for i in xrange(0, len(chunk), 57):
+                    fp.write(binascii.b2a_base64(chunk[i:i+57]))
+            fp.write(boundary)
+        src.close()
+    fp.write('--\n')
+
+def _blob_reference(part, lines):
+    """Return (blob name, attachment headers) for PART, or (None, PART)."""
+    if part.get_content_type() != 'message/external-body' or part.get_param('access-type') != blob_access_type:
+        return None, part
+    import email.parser
+    return part.get_param('name'), email.parser.HeaderParser().parsestr(''.join(lines))
+
+def _store_attachments(msg, blobs):
+    """Move the attachments of MSG to BLOBS, leaving references to them."""
+    from email.mime.base import MIMEBase
+    import email.message
+    for container in [part for part in msg.walk() if part.is_multipart()]:
+        parts = container.get_payload()
+        for i, part in enumerate(parts):
+            if part.is_multipart() or part.get_content_maintype() == 'message': continue
+            if part.get('Content-Disposition', '').split(';')[0].strip().lower() != 'attachment': continue
+            data = part.get_payload(decode = True) or ''
+            attachment = email.message.Message()
+            for k, v in part.items():
+                if k.lower() != 'content-transfer-encoding': attachment[k] = v
+            attachment.set_param('size', str(len(data)), header = 'Content-Disposition')
+            reference = MIMEBase('message', 'external-body')
+            reference.set_param('access-type', blob_access_type)
+            reference.set_param('name', blobs.add_data(data))
+            reference.set_payload([attachment])
+            parts[i] = reference
+
+class IssueBlobs(object):
+    """Attachments stored once, by SHA-256, in ISSUES_PATH/.blobs; the new
+    files accumulate in ADDED."""
+
+    def __init__(self, issues_path, compress = False):
+        self.path = os.path.join(issues_path, blobs_dir)
+        self.compress = compress
+        self.added = []
+
+    def add(self, filename):
+        """Store the file FILENAME, a chunk at a time, unless it's already
+        stored; return the name of its blob."""
+        return self._store(open(filename, 'rb'))
+
+    def add_data(self, data):
+        """Store the string DATA, like add()."""
+        return self._store(_string_file(data))
+
+    def _store(self, src):
+        """Store the contents of the file SRC, and close it."""
+        import hashlib, zlib
+        if not os.path.exists(self.path): os.mkdir(self.path)
+        digest = hashlib.sha256()
+        compressor = self.compress and zlib.compressobj()
+        tmp = os.path.join(self.path, '.tmp-' + _random_id())
+        try:
+            out = open(tmp, 'wb')
+            try:
+                for chunk in iter(lambda: src.read(chunk_size), ''):
+                    digest.update(chunk)
+                    out.write(compressor.compress(chunk) if compressor else chunk)
+                if compressor: out.write(compressor.flush())
+            finally:
+                src.close()
+                out.close()
+            name = digest.hexdigest()
+            if self._find(name):
+                os.remove(tmp)
+            else:
+                path = os.path.join(self.path, name + (self.compress and '.z' or ''))
+                os.rename(tmp, path)
+                self.added.append(path)
+        except:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+        return name
+
+    def _find(self, name):
+        """The path of the blob NAME, and whether it's compressed, or None."""
+        for suffix, compressed in (('', False), ('.z', True)):
+            path = os.path.join(self.path, name + suffix)
+            if os.path.exists(path): return path, compressed
+        return None
+
+    def read(self, name):
+        """Yield the contents of the blob NAME, a chunk at a time."""
+        import zlib
+        found = self._find(name)
+        if not found: raise IOError('missing blob %s in %s' % (name, self.path))
+        path, compressed = found
+        decompressor = compressed and zlib.decompressobj()
+        fp = open(path, 'rb')
+        try:
+            for chunk in iter(lambda: fp.read(chunk_size), ''):
+                yield decompressor.decompress(chunk) if decompressor else chunk
+            if decompressor: yield decompressor.flush()
+        finally:
+            fp.close()
+
+def _attachments(ui):
+    """How iadd stores attachments: 'inline' in the messages, or in 'blobs',
+    or 'compressed-blobs'."""
+    attachments = ui.config('artemis', 'attachments', default = 'inline')
+    if attachments not in ('inline', 'blobs', 'compressed-blobs'):
+        raise ValueError('unknown attachments %r (should be inline, blobs, or compressed-blobs)' % attachments)
+    return attachments
+
+def _flatten(msg):
+    """MSG as a string, formatted the way mailbox writes messages."""
+    from cStringIO import StringIO
+    from email.generator import Generator
+    out = StringIO()
+    Generator(out, False, 0).flatten(msg)
+    return out.getvalue()
 
+def _read_formats(ui):
+    """Return the SummaryFormat given by the format settings in [artemis]."""
+    default = default_format
+    rules = []
     for k,v in ui.configitems('artemis'):
         if not k.startswith('format'): continue
         if k == 'format':
-            default_format = v
+            default = v
             continue
-        formats.append((k.split(':')[1], v))
-
-    return formats
-
-def _format_match(props, formats):
-    for k,v in formats:
-        eq = k.split('&')
-        eq = [e.split('*') for e in eq]
-        for e in eq:
-            if props[e[0]] != e[1]:
+        rules.append((k.split(':')[1], v))
+    return SummaryFormat(default, rules)
+
+# Borrowed from termcolor
+_ansi_codes = dict((k, '\033[%dm' % v) for k,v in
+                   zip(['bold', 'dark', '', 'underline', 'blink', '', 'reverse', 'concealed'], range(1, 9)) +
+                   zip(['grey', 'red', 'green', 'yellow', 'blue', 'magenta', 'cyan', 'white'], range(30, 38)))
+_ansi_codes['reset'] = '\033[0m'
+del _ansi_codes['']
+
+_format_names_re = re.compile(r'%\(([^)]*)\)')
+
+class SummaryFormat(object):
+    """The formats of the summary lines, compiled once; must stay picklable."""
+
+    def __init__(self, default, rules):
+        self.default = default
+        self.rules = [([tuple((c.split('*') + [''])[:2]) for c in rule.split('&')], format)
+                      for rule, format in rules]
+        self.names = dict((format, sorted(set(_format_names_re.findall(format))))
+                          for format in [default] + [f for c,f in self.rules])
+        self.headers = set(n.lower() for names in self.names.itervalues() for n in names)
+        self.headers.update(name.lower() for conditions, f in self.rules for name, value in conditions)
+
+    def uses(self, name):
+        """Whether any of the formats refers to NAME."""
+        return any(name in names for names in self.names.itervalues())
+
+    def __call__(self, headers, issue_id, length, shortid = None):
+        """Return the summary line of the issue ISSUE_ID, with LENGTH
+        messages, and root HEADERS, a list of (name, value)."""
+        props = {}
+        for k,v in headers:
+            k = k.lower()
+            if k in self.headers: props[k] = v
+        props['id'] = issue_id
+        props['shortid'] = shortid or issue_id
+        props['len'] = length-1                 # number of replies (-1 for self)
+
+        format = self.default
+        for conditions, f in self.rules:
+            if all(props.get(name.lower(), _ansi_codes.get(name.lower(), '')) == value
+                   for name, value in conditions):
+                format = f
                 break
-        else:
-            return v
-
-    return default_format
-
-def _summary_line(mbox, root, issue, formats):
-    props = PropertiesDictionary(mbox[root])
-    props['id']  = issue
-    props['len'] = len(mbox)-1              # number of replies (-1 for self)
-
-    return _format_match(props, formats) % props
-
-class PropertiesDictionary(dict):
-    def __init__(self, msg):
-        # Borrowed from termcolor
-        for k,v in zip(['bold', 'dark', '', 'underline', 'blink', '', 'reverse', 'concealed'], range(1, 9)) + \
-                   zip(['grey', 'red', 'green', 'yellow', 'blue', 'magenta', 'cyan', 'white'], range(30, 38)):
-            self[k] = '\033[' + str(v) + 'm'
-        self['reset']  = '\033[0m'
-        del self['']
+        values = {}
+        for name in self.names[format]:
+            key = name.lower()
+            values[name] = props[key] if key in props else _ansi_codes.get(key, '')
+        return format % values
+
+class IssueMaildir(object):
+    """Messages of a single issue, stored in the maildir DIRNAME."""
+
+    def __init__(self, dirname):
+        self._path = dirname
+        self._maildir = None
+        self._toc = {}
+        for subdir in maildir_dirs[:2]:     # same order as mailbox.Maildir
+            try:
+                entries = os.listdir(os.path.join(dirname, subdir))
+            except OSError:
+                continue
+            for entry in entries:
+                if os.path.isdir(os.path.join(dirname, subdir, entry)): continue
+                self._toc[entry.split(':')[0]] = os.path.join(subdir, entry)
+
+    @property
+    def maildir(self):
+        if self._maildir is None:
+            import mailbox
+            self._maildir = mailbox.Maildir(self._path, factory=mailbox.MaildirMessage)
+        return self._maildir
+
+    def keys(self):
+        return self._toc.keys()
+
+    def iterkeys(self):
+        return self._toc.iterkeys()
+
+    def __len__(self):
+        return len(self._toc)
+
+    def __contains__(self, key):
+        return key in self._toc
+
+    def name(self, key):
+        """Name of the file of the message KEY in the maildir (e.g., new/KEY)."""
+        return self._toc[key]
+
+    def path(self, key):
+        """Path of the file that stores the message KEY."""
+        return os.path.join(self._path, self._toc[key])
+
+    def get_file(self, key):
+        return open(os.path.join(self._path, self._toc[key]), 'rb')
+
+    def get_headers(self, key):
+        """Return a message with only the headers of the message KEY."""
+        fp = self.get_file(key)
+        try:
+            msg = _read_headers(fp)
+            _read_bytes[0] += fp.tell()
+            return msg
+        finally:
+            fp.close()
 
-        for k,v in msg.items():
-            self[k] = v
+    def __getitem__(self, key):
+        return self.maildir[key]
+
+    def __setitem__(self, key, message):
+        self.maildir[key] = message
+        self._toc[key] = self.maildir._lookup(key)
+
+    def add(self, message):
+        key = self.maildir.add(message)
+        self._toc[key] = self.maildir._lookup(key)
+        return key
+
+    def add_file(self, write):
+        """Add a message that WRITE(fp) writes to a file in the maildir
+        itself, and return its key."""
+        path = self._write_tmp(write)
+        key = os.path.basename(path).split(':')[0]
+        os.rename(path, os.path.join(self._path, 'new', key))
+        self._toc[key] = os.path.join('new', key)
+        return key
+
+    def set_headers(self, key, headers):
+        """Set HEADERS, a list of (name, value), in the message KEY (None
+        removes a header)."""
+        import shutil
+        src = self.get_file(key)
+        try:
+            msg = _read_headers(src)
+            _set_headers(msg, headers)
+            def write(fp):
+                fp.write(_flatten(msg))
+                shutil.copyfileobj(src, fp, chunk_size)
+            path = self._write_tmp(write)
+        finally:
+            src.close()
+        os.rename(path, os.path.join(self._path, self._toc[key]))
+
+    def _write_tmp(self, write):
+        """Call WRITE with a new file in the tmp directory; return its path."""
+        fp = self.maildir._create_tmp()
+        try:
+            write(fp)
+        except:
+            fp.close()
+            os.remove(fp.name)
+            raise
+        fp.close()
+        return fp.name
+
+    def lock(self):
+        pass            # mailbox.Maildir doesn't lock either
+
+    def close(self):
+        if self._maildir is not None: self._maildir.close()
+
+class RevisionFiles(object):
+    """Files of the repository REPO at revision REV."""
+
+    def __init__(self, repo, rev):
+        try:
+            from mercurial.logcmdutil import revsingle
+        except ImportError:
+            from mercurial.scmutil import revsingle
+        self.repo = repo
+        self.ctx = revsingle(repo, rev)
+
+    def files(self, directory):
+        """Return the paths (relative to the root) of the files in DIRECTORY."""
+        from mercurial import match
+        matcher = match.match(self.repo.root, '', ['path:' + directory])
+        return sorted(self.ctx.manifest().walk(matcher))
+
+    def read(self, paths):
+        """Yield (path, contents) for each of PATHS, in order."""
+        for path in paths:
+            yield path, self.ctx[path].data()
+
+    def changed(self, directory):
+        """Return the paths of the files in DIRECTORY changed since the revision."""
+        from mercurial import match
+        matcher = match.match(self.repo.root, '', ['path:' + directory])
+        status = self.repo.status(self.ctx.node(), None, matcher, unknown = True)
+        return set(status.modified + status.added + status.removed + status.deleted + status.unknown)
+
+    def close(self):
+        pass
+
+class RevisionIssues(object):
+    """The issues in ISSUES_DIR (relative to the root of the repository) as
+    of a revision, whose files are read through FILES, a RevisionFiles."""
+
+    def __init__(self, files, issues_dir):
+        self.files = files
+        self._tocs = {}                 # issue id -> {key: path}
+        self._packs = {}                # issue id -> path, for packed issues
+        prefix = issues_dir + '/'
+        for path in files.files(issues_dir):
+            parts = path[len(prefix):].split('/')
+            if parts[0].startswith('.'): continue
+            if len(parts) == 1:
+                self._packs[parts[0]] = path
+                self._tocs[parts[0]] = {}
+                continue
+            if len(parts) != 3 or parts[1] not in maildir_dirs[:2]: continue
+            toc = self._tocs.setdefault(parts[0], {})
+            key = parts[2].split(':')[0]
+            if key not in toc or parts[1] == 'cur':     # as in IssueMaildir
+                toc[key] = path
+        self.ids = IssueIds(None, self._tocs)
+
+    def maildir(self, issue_id):
+        if issue_id in self._packs:
+            for path, data in self.files.read([self._packs[issue_id]]):
+                return IssuePack(path, data)
+        return RevisionMaildir(self.files, self._tocs[issue_id])
+
+    def maildirs(self):
+        """Yield (issue id, messages) for every issue, in one pass."""
+        paths = (path for issue_id in self.ids.ids
+                      for path in (issue_id in self._packs and [self._packs[issue_id]] or
+                                   sorted(self._tocs[issue_id].values())))
+        contents = self.files.read(paths)
+        for issue_id in self.ids.ids:
+            if issue_id in self._packs:
+                path, data = contents.next()
+                _read_bytes[0] += len(data)
+                yield issue_id, IssuePack(path, data)
+                continue
+            toc = self._tocs[issue_id]
+            headers = {}
+            for i in xrange(len(toc)):
+                path, data = contents.next()
+                headers[path] = _read_headers(_string_file(data))
+                _read_bytes[0] += len(data)
+            yield issue_id, RevisionMaildir(self.files, toc, headers)
+
+    def close(self):
+        self.files.close()
+
+def _string_file(data):
+    import cStringIO
+    return cStringIO.StringIO(data)
+
+class RevisionMaildir(object):
+    """Messages of an issue as of a revision, read-only."""
+
+    def __init__(self, files, toc, headers = None):
+        self.files = files
+        self._toc = toc
+        self._headers = headers or {}
+
+    def keys(self):
+        return self._toc.keys()
+
+    def iterkeys(self):
+        return self._toc.iterkeys()
+
+    def __len__(self):
+        return len(self._toc)
+
+    def __contains__(self, key):
+        return key in self._toc
+
+    def get_file(self, key):
+        for path, data in self.files.read([self._toc[key]]):
+            return _string_file(data)
+
+    def get_headers(self, key):
+        path = self._toc[key]
+        if path in self._headers: return self._headers[path]
+        fp = self.get_file(key)
+        msg = _read_headers(fp)
+        _read_bytes[0] += fp.tell()
+        return msg
+
+    def close(self):
+        pass
+
+def _set_headers(msg, headers):
+    for name, value in headers:
+        if value is None:
+            del msg[name]
+        elif name in msg:
+            msg.replace_header(name, value)
+        else:
+            msg.add_header(name, value)
+
+def _storage(ui):
+    """The format of new issues: 'maildir', or 'packed'."""
+    storage = ui.config('artemis', 'storage', default = 'maildir')
+    if storage not in ('maildir', 'packed'):
+        raise ValueError('unknown storage %r (should be maildir or packed)' % storage)
+    return storage
+
+def _property_changes(ui):
+    """How iadd changes the properties of an issue: 'rewrite' the root
+    message, or 'append' the changes to the new message."""
+    changes = ui.config('artemis', 'properties', default = 'rewrite')
+    if changes not in ('rewrite', 'append'):
+        raise ValueError('unknown properties %r (should be rewrite or append)' % changes)
+    return changes
+
+def _open_issue(issue, packed = False):
+    """Return the messages of the issue ISSUE (a new one is a pack if PACKED)."""
+    if os.path.isfile(issue) or (packed and not os.path.exists(issue)):
+        return IssuePack(issue)
+    return IssueMaildir(issue)
+
+_pack_count = [0]
+
+class IssuePack(object):
+    """Messages of a single issue, appended to the file PATH (read-only
+    DATA, if given)."""
+
+    def __init__(self, path, data = None):
+        self._path = path
+        self._data = data
+        self._reader = None
+        self._toc = {}                  # key -> (name, offset, length)
+        try:
+            fp = self._open()
+        except IOError:
+            return                      # a new pack
+        try:
+            self._scan(fp)
+        finally:
+            fp.close()
 
-    def __contains__(self, k):
-        return super(PropertiesDictionary, self).__contains__(k.lower())
+    def _open(self):
+        if self._data is not None: return _string_file(self._data)
+        return open(self._path, 'rb')
+
+    def _scan(self, fp):
+        """Read the table of the records; return where the last complete
+        one ends."""
+        fp.seek(0, 2)
+        size = fp.tell()
+        fp.seek(0)
+        header = fp.readline()
+        if not header: return 0
+        if header.split() != ['artemis-pack', str(pack_version)]:
+            raise ValueError('%s is not an issue pack' % self._path)
+        end = fp.tell()
+        while True:
+            record = fp.readline().split()
+            if len(record) != 3 or record[0] != 'artemis-message' or not record[2].isdigit():
+                break                   # the end, or a record still being written (or torn)
+            name, offset, length = record[1], fp.tell(), int(record[2])
+            if offset + length + 1 > size: break
+            self._toc[name.split('/')[-1].split(':')[0]] = (name, offset, length)
+            end = offset + length + 1
+            fp.seek(end)
+        return end
+
+    def keys(self):
+        return self._toc.keys()
+
+    def iterkeys(self):
+        return self._toc.iterkeys()
+
+    def __len__(self):
+        return len(self._toc)
+
+    def __contains__(self, key):
+        return key in self._toc
+
+    def name(self, key):
+        return self._toc[key][0]
+
+    def path(self, key):
+        return self._path
+
+    def get_file(self, key):
+        name, offset, length = self._toc[key]
+        return _FileSlice(self._open(), offset, length)
+
+    def get_headers(self, key):
+        """Return a message with only the headers of the message KEY."""
+        if self._reader is None: self._reader = self._open()
+        name, offset, length = self._toc[key]
+        fp = _FileSlice(self._reader, offset, length)
+        msg = _read_headers(fp)
+        _read_bytes[0] += fp.tell()
+        return msg
+
+    def __getitem__(self, key):
+        import mailbox
+        fp = self.get_file(key)
+        try:
+            return mailbox.MaildirMessage(fp.read())
+        finally:
+            fp.close()
 
-    def __getitem__(self, k):
-        if k not in self: return ''
-        return super(PropertiesDictionary, self).__getitem__(k.lower())
+    def __setitem__(self, key, message):
+        self._append(self._toc[key][0], lambda fp: fp.write(_flatten(message)))
+
+    def add(self, message):
+        return self.add_file(lambda fp: fp.write(_flatten(message)))
+
+    def add_file(self, write, name = None):
+        """Add a message that WRITE(fp) writes, and return its key."""
+        if name is None:
+            import socket
+            now = time.time()
+            _pack_count[0] += 1
+            host = socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+            name = 'new/%d.M%dP%dQ%d.%s' % (int(now), int((now % 1) * 1e6), os.getpid(), _pack_count[0], host)
+        return self._append(name, write)
+
+    def set_headers(self, key, headers):
+        """Set HEADERS, a list of (name, value), in the message KEY, as
+        IssueMaildir.set_headers() does, by appending the changed message."""
+        import shutil
+        src = self.get_file(key)
+        try:
+            msg = _read_headers(src)
+            _set_headers(msg, headers)
+            def write(fp):
+                fp.write(_flatten(msg))
+                shutil.copyfileobj(src, fp, chunk_size)
+            self._append(self._toc[key][0], write)
+        finally:
+            src.close()
+
+    def _append(self, name, write):
+        """Append the record NAME, whose message WRITE(fp) writes; return its key."""
+        import fcntl
+        if self._data is not None: raise IOError('%s is read-only' % self._path)
+        fp = open(self._path, 'ab')         # create it if need be
+        fp.close()
+        fp = open(self._path, 'r+b')
+        try:
+            fcntl.lockf(fp, fcntl.LOCK_EX)
+            start = self._scan(fp)
+            fp.seek(0, 2)
+            if fp.tell() > start: fp.truncate(start)
+            fp.seek(start)
+            try:
+                if not start: fp.write('artemis-pack %d\n' % pack_version)
+                record = fp.tell()
+                fp.write('artemis-message %s %s\n' % (name, '-' * 12))
+                offset = fp.tell()
+                write(fp)
+                length = fp.tell() - offset
+                fp.write('\n')
+                fp.seek(record)
+                fp.write('artemis-message %s %012d\n' % (name, length))
+                fp.flush()
+            except:
+                fp.truncate(start)
+                raise
+        finally:
+            fp.close()                      # and unlock
+        key = name.split('/')[-1].split(':')[0]
+        self._toc[key] = (name, offset, length)
+        return key
+
+    def lock(self):
+        pass            # every append locks the pack
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+class _FileSlice(object):
+    """The LENGTH bytes at OFFSET in the file FP, as a file of their own
+    (closing it closes FP)."""
+
+    def __init__(self, fp, offset, length):
+        self._fp = fp
+        self._offset = offset
+        self._pos = 0
+        self._length = length
+
+    def _left(self, size):
+        left = self._length - self._pos
+        if size is not None and 0 <= size < left: left = size
+        return left
+
+    def read(self, size = -1):
+        self._fp.seek(self._offset + self._pos)
+        data = self._fp.read(self._left(size))
+        self._pos += len(data)
+        return data
+
+    def readline(self, size = -1):
+        self._fp.seek(self._offset + self._pos)
+        line = self._fp.readline(self._left(size))
+        self._pos += len(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._fp.close()
+
+class IssueThread(object):
+    """Messages of an issue: the root message first, then the replies by date."""
+
+    def __init__(self, mbox):
+        self.mbox = mbox
+        self._headers = {}
+        self._dates = {}
+        self.root = None
+        for k in mbox.iterkeys():
+            self._read(k)
+            if not self.root and 'in-reply-to' not in self._headers[k]:
+                self.root = k
+        self._order()
+
+    def _read(self, key):
+        msg = self.mbox.get_headers(key)
+        self._headers[key] = msg
+        self._dates[key] = _parse_date(msg['date'])
+
+    def _order(self):
+        self.keys = sorted(self._headers, key = lambda k: (k != self.root, self._dates[k]))
+        self._links = None
+        self._properties = None
+
+    def _link(self):
+        """Link the messages into their reply tree, the first time it's needed
+        (listing the issues doesn't need it)."""
+        if self._links is None:
+            # Message-Id -> (index, headers), In-Reply-To -> [Message-Id]
+            messages = {}
+            children = {}
+            for i,k in enumerate(self.keys):
+                m = self._headers[k]
+                messages[m['Message-Id']] = (i,m)
+                children.setdefault(m['In-Reply-To'], []).append(m['Message-Id'])
+            children[None] = []         # Safeguard against infinte loop on empty Message-Id
+            self._links = messages, children
+        return self._links
+
+    def replies(self, index):
+        """Yield the (index, depth) of every reply under the message at INDEX,
+        in the order of the reply tree (depth first, by date)."""
+        messages, children = self._link()
+        stack = [(id, 1) for id in reversed(children.get(self.headers(index)['Message-Id'], []))]
+        while stack:
+            id, depth = stack.pop()
+            stack += [(child, depth + 1) for child in reversed(children.get(id, []))]
+            yield messages[id][0], depth
+
+    def refresh(self, key):
+        """Re-read the message KEY after it was added or replaced."""
+        self._read(key)
+        if not self.root: self.root = key
+        self._order()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def headers(self, index):
+        return self._headers[self.keys[index]]
+
+    def changes(self):
+        """Yield the (index, name, value) of the property changes recorded
+        in the replies (in X-Artemis-Property headers), in order."""
+        for i in xrange(1, len(self.keys)):
+            for change in self._headers[self.keys[i]].get_all(property_header) or []:
+                name, value = (change.split('=', 1) + [''])[:2]
+                yield i, name.strip(), value.strip()
+
+    def properties(self):
+        """The headers of the root message, with the property changes of the
+        replies applied in order: the issue's effective properties."""
+        if self._properties is None:
+            headers = self.headers(0).items()
+            for i, name, value in self.changes():
+                for n, (k, v) in enumerate(headers):
+                    if k.lower() == name.lower():
+                        headers[n] = (k, value)
+                        break
+                else:
+                    headers.append((name, value))
+            self._properties = Headers(headers)
+        return self._properties
+
+    def date(self, index):
+        return self._dates[self.keys[index]]
+
+    def open(self, index):
+        """Open the file of the message at INDEX."""
+        return self.mbox.get_file(self.keys[index])
+
+_date_re = re.compile(r'[+-]\d{4}$')
+
+def _parse_date(date):
+    """Parse the Date header of a message, like Mercurial's parsedate()."""
+    if date and _date_re.search(date.strip()):
+        import email.utils
+        parsed = email.utils.parsedate_tz(date)
+        if parsed and parsed[9] is not None:
+            return (email.utils.mktime_tz(parsed), -parsed[9])
+    return tuple(parsedate(date))
+
+def _read_headers(fp):
+    """Parse the headers at the current position of FP, reading up to the
+    blank line that ends them and no further."""
+    lines = []
+    while True:
+        line = fp.readline()
+        if line in ('', '\n', '\r\n'): break
+        lines.append(line)
+    import email.parser
+    return email.parser.HeaderParser().parsestr(''.join(lines))
+
+class MessageParts(object):
+    """The parts of the message in the file FP, read as a stream of
+    (headers, lines)."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.headers = _read_headers(fp)
+        self.delimiter = None           # the boundary line that ended the last body
+
+    def __iter__(self):
+        return self._walk(self.headers, ())
+
+    def _walk(self, headers, boundaries):
+        boundary = headers.get_content_maintype() == 'multipart' and headers.get_boundary()
+        if not boundary:
+            lines = self._body(boundaries)
+            yield headers, lines
+            for line in lines: pass
+            return
 
-    def __setitem__(self, k, v):
-        super(PropertiesDictionary, self).__setitem__(k.lower(), v)
+        boundary = '--' + boundary
+        inner = boundaries + (boundary,)
+        for line in self._body(inner): pass             # preamble
+        while self.delimiter == boundary:
+            for part in self._walk(_read_headers(self.fp), inner):
+                yield part
+        if self.delimiter == boundary + '--':
+            for line in self._body(boundaries): pass    # epilogue
+
+    def _body(self, boundaries):
+        """Yield the lines up to the next boundary line of any of BOUNDARIES;
+        the line break before the boundary belongs to it, not to the body."""
+        self.delimiter = None
+        previous = None
+        for line in iter(self.fp.readline, ''):
+            if boundaries and line.startswith('--'):
+                stripped = line.rstrip()
+                if stripped in boundaries or (stripped.endswith('--') and stripped[:-2] in boundaries):
+                    self.delimiter = stripped
+                    if previous is not None:
+                        yield previous.rstrip('\r\n')
+                    return
+            if previous is not None:
+                yield previous
+            previous = line
+        if previous is not None:
+            yield previous
+
+def _part_size(part, lines):
+    """Size of a message part: the size parameter of its Content-Disposition,
+    if any, or else the length of its (encoded) body."""
+    size = part.get_param('size', header = 'content-disposition')
+    if isinstance(size, str) and size.isdigit():
+        return int(size)
+    return sum(len(line) for line in lines)
+
+def _decode_lines(lines, encoding):
+    """Decode the raw LINES of a body in the Content-Transfer-Encoding
+    ENCODING, yielding the data a chunk at a time."""
+    import binascii
+    encoding = (encoding or '').strip().lower()
+    if encoding == 'base64':
+        data = []
+        length = 0
+        for line in lines:
+            line = line.strip()
+            data.append(line)
+            length += len(line)
+            if length >= chunk_size * 4 / 3:
+                data = ''.join(data)
+                whole = len(data) - len(data) % 4
+                yield _decode_base64(data[:whole])
+                data = [data[whole:]]
+                length = len(data[0])
+        yield _decode_base64(''.join(data))
+    elif encoding == 'quoted-printable':
+        for line in lines:
+            yield binascii.a2b_qp(line)
+    else:
+        for line in lines:
+            yield line
+
+def _decode_base64(data):
+    import binascii
+    try:
+        return binascii.a2b_base64(data)
+    except binascii.Error:
+        return data                     # undecoded, like get_payload(decode = True)
 
 # vim: expandtab
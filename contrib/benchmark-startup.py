@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Time the startup of hg with and without the artemis extension, and of
+git-artemis list, in throw-away repositories. Exits with status 1 if
+loading the extension, or git-artemis list, takes longer than the budget.
+
+    python contrib/benchmark-startup.py [-n RUNS] [--budget-ms MS]
+"""
+
+import os, sys, shutil, subprocess, tempfile, time
+from argparse import ArgumentParser
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+extension = os.path.join(top, 'artemis')
+git_artemis = os.path.join(top, 'git-artemis')
+
+def timeit(argv, cwd, runs):
+    """Return the sorted wall-clock times, in milliseconds, of RUNS runs of ARGV."""
+    devnull = open(os.devnull, 'w')
+    times = []
+    for i in xrange(runs):
+        start = time.time()
+        subprocess.check_call(argv, cwd = cwd, stdout = devnull)
+        times.append((time.time() - start) * 1000)
+    devnull.close()
+    return sorted(times)
+
+def main():
+    parser = ArgumentParser(description = 'Benchmark the startup of hg with artemis and of git-artemis.')
+    parser.add_argument('-n', '--runs', type = int, default = 10, help = 'runs of each command')
+    parser.add_argument('--budget-ms', type = float, default = 50,
+                        help = 'time the extension may add to hg, and git-artemis list may take')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix = 'artemis-startup-')
+    try:
+        hg_repo = os.path.join(tmp, 'hg')
+        git_repo = os.path.join(tmp, 'git')
+        subprocess.check_call(['hg', 'init', hg_repo])
+        subprocess.check_call(['git', 'init', '-q', git_repo])
+        os.makedirs(os.path.join(git_repo, '.issues'))
+
+        with_artemis = ['--config', 'extensions.artemis=' + extension]
+        results = [
+            ('hg version', timeit(['hg', 'version', '-q'], hg_repo, args.runs)),
+            ('hg version (artemis)', timeit(['hg'] + with_artemis + ['version', '-q'], hg_repo, args.runs)),
+            ('hg ilist', timeit(['hg'] + with_artemis + ['ilist'], hg_repo, args.runs)),
+            ('git-artemis list', timeit([sys.executable, git_artemis, 'list'], git_repo, args.runs)),
+        ]
+    finally:
+        shutil.rmtree(tmp)
+
+    print '%-22s %9s %9s' % ('', 'min ms', 'median ms')
+    for name, times in results:
+        print '%-22s %9.1f %9.1f' % (name, times[0], times[len(times) // 2])
+
+    medians = dict((name, times[len(times) // 2]) for name, times in results)
+    overhead = medians['hg version (artemis)'] - medians['hg version']
+    print '\nextension overhead: %.1f ms, budget %.1f ms' % (overhead, args.budget_ms)
+    failed = False
+    if overhead > args.budget_ms:
+        print 'FAIL: loading the extension is over budget'
+        failed = True
+    if medians['git-artemis list'] > args.budget_ms:
+        print 'FAIL: git-artemis list is over budget'
+        failed = True
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
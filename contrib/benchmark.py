@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""Generate a synthetic issue tracker, and time artemis on it, through both
+the hg extension and git-artemis. Reports the median wall-clock time and the
+peak RSS of every command; results can be saved, and compared against a
+saved baseline (exits with status 1 if anything got slower than the
+threshold allows).
+
+    python contrib/benchmark.py [-n RUNS] [--issues N] [--comments N] ...
+    python contrib/benchmark.py --save baseline.json
+    python contrib/benchmark.py --compare baseline.json
+
+The tracker is generated from --seed, so the same parameters give the same
+tracker. Properties are given as NAME=VALUE:WEIGHT,VALUE:WEIGHT,...
+"""
+
+import os, sys, shutil, subprocess, tempfile, time, random, calendar, json
+import email
+from argparse import ArgumentParser
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+from artemis import artemis
+
+extension = os.path.join(top, 'artemis')
+git_artemis = os.path.join(top, 'git-artemis')
+user_name, user_email = 'Bench Mark', 'bench@example.com'
+user = '%s <%s>' % (user_name, user_email)
+words = ('issue crash list show add index parser thread message reply state '
+         'property filter format date attachment maildir commit repository '
+         'extension command option value error warning release version patch '
+         'test build fix broken slow fast memory file directory header body').split()
+
+# name, arguments (ISSUE is replaced by the busiest issue)
+benchmarks = [
+    ('ilist',            ['ilist']),
+    ('ilist -a',         ['ilist', '-a']),
+    ('ilist -p',         ['ilist', '-a', '-p', 'priority=high']),
+    ('ilist -f',         ['ilist', '-f', 'bench']),
+    ('ilist -d',         ['ilist', '-a', '-d', '>2015-07-01']),
+    ('ilist -o latest',  ['ilist', '-a', '-o', 'latest']),
+    ('ishow',            ['ishow', 'ISSUE']),
+    ('ishow --all',      ['ishow', '--all', 'ISSUE']),
+    ('iadd',             ['iadd', 'ISSUE', '-m', 'benchmark comment']),
+]
+
+def parse_property(spec):
+    """NAME=VALUE:WEIGHT,... -> (NAME, [(VALUE, WEIGHT)])"""
+    name, values = spec.split('=', 1)
+    distribution = []
+    for v in values.split(','):
+        value, weight = (v.rsplit(':', 1) + ['1'])[:2]
+        distribution.append((value, float(weight)))
+    return name, distribution
+
+def choose(rng, distribution):
+    x = rng.random() * sum(w for v,w in distribution)
+    for value, weight in distribution:
+        x -= weight
+        if x < 0: break
+    return value
+
+def sentence(rng, n):
+    return ' '.join(rng.choice(words) for i in xrange(n))
+
+def generate(issues_path, args):
+    """Write a synthetic tracker into ISSUES_PATH; return the id of the issue
+    with the most messages."""
+    rng = random.Random(args.seed)
+    properties = [parse_property(p) for p in args.property]
+    start = calendar.timegm((2015, 1, 1, 0, 0, 0))
+
+    attachment = None
+    if args.attachment_size:
+        attachment = os.path.join(os.path.dirname(issues_path), 'attachment.bin')
+        block = ''.join(chr(rng.randrange(256)) for i in xrange(65536))
+        fp = open(attachment, 'wb')
+        for i in xrange(0, args.attachment_size, len(block)):
+            fp.write(block[:args.attachment_size - i])
+        fp.close()
+
+    os.makedirs(issues_path)
+    busiest, most = None, -1
+    for n in xrange(args.issues):
+        issue_id = '%016x' % rng.getrandbits(64)
+        issue = os.path.join(issues_path, issue_id)
+        for d in artemis.maildir_dirs: os.makedirs(os.path.join(issue, d))
+
+        date = start + rng.randrange(365 * 24 * 3600)
+        subject = sentence(rng, rng.randint(3, 8))
+        comments = rng.randint(0, 2 * args.comments)
+        depths = []                     # depth of every message, for replies
+        for i in xrange(comments + 1):
+            lines = ['From: %s' % user,
+                     'Date: %s' % time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(date))]
+            if i == 0:
+                lines.append('Subject: %s' % subject)
+                for name, distribution in properties:
+                    lines.append('%s: %s' % (name, choose(rng, distribution)))
+                lines.append('Message-Id: <%s-0-artemis@bench>' % issue_id)
+                depths.append(0)
+            else:
+                parent = rng.choice([j for j,d in enumerate(depths) if d < args.depth])
+                parent_id = parent and '%s-%d' % (issue_id, parent) or '%s-0' % issue_id
+                lines.append('Subject: Re: %s' % subject)
+                lines.append('Message-Id: <%s-%d-artemis@bench>' % (issue_id, i))
+                lines.append('References: <%s-artemis@bench>' % parent_id)
+                lines.append('In-Reply-To: <%s-artemis@bench>' % parent_id)
+                depths.append(depths[parent] + 1)
+            body = '\n'.join(sentence(rng, 12) for j in xrange(rng.randint(1, 10)))
+            text = '\n'.join(lines) + '\n\n' + body + '\n'
+
+            key = '%d.M%dP%dQ%d.bench' % (date, i, n, i)
+            fp = open(os.path.join(issue, 'new', key), 'wb')
+            if attachment and rng.random() < args.attachment_ratio:
+                artemis._attach_files(fp, email.message_from_string(text), [attachment])
+            else:
+                fp.write(text)
+            fp.close()
+            date += rng.randrange(3 * 24 * 3600)
+
+        if comments > most:
+            busiest, most = issue_id, comments
+
+    if properties:
+        name, distribution = properties[-1]
+        fp = open(os.path.join(issues_path, '.filter'), 'w')
+        fp.write('[bench]\n%s = %s\n' % (name, distribution[-1][0]))
+        fp.close()
+    if attachment: os.remove(attachment)
+    return busiest
+
+def run(argv, cwd):
+    """Run ARGV; return its wall-clock time (ms) and its peak RSS (kB)."""
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    p = subprocess.Popen(argv, cwd = cwd, stdout = devnull, stderr = devnull)
+    pid, status, usage = os.wait4(p.pid, 0)
+    elapsed = (time.time() - start) * 1000
+    p.returncode = status
+    devnull.close()
+    if status:
+        raise Exception('%s failed' % ' '.join(argv))
+    return elapsed, usage.ru_maxrss
+
+def measure(name, argv, cwd, runs):
+    times, rss = [], 0
+    for i in xrange(runs):
+        t, r = run(argv, cwd)
+        times.append(t)
+        rss = max(rss, r)
+    times.sort()
+    return name, { 'time': times[len(times) // 2], 'min': times[0], 'rss': rss }
+
+def main():
+    parser = ArgumentParser(description = 'Benchmark artemis on a synthetic issue tracker.')
+    parser.add_argument('-n', '--runs', type = int, default = 5, help = 'runs of each command')
+    parser.add_argument('--issues', type = int, default = 1000, help = 'number of issues')
+    parser.add_argument('--comments', type = int, default = 5, help = 'average number of comments per issue')
+    parser.add_argument('--depth', type = int, default = 3, help = 'maximum depth of the reply trees')
+    parser.add_argument('--property', action = 'append', default = None,
+                        help = 'property distribution, e.g. state=new:5,resolved:3')
+    parser.add_argument('--attachment-size', type = int, default = 0, help = 'size of attachments, in bytes')
+    parser.add_argument('--attachment-ratio', type = float, default = 0.05,
+                        help = 'fraction of the messages with an attachment')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the generator')
+    parser.add_argument('--index', action = 'store_true', help = 'build the index (iindex) before timing')
+    parser.add_argument('--only', choices = ['hg', 'git'], help = 'time only one of the front ends')
+    parser.add_argument('--keep', metavar = 'DIR', help = 'generate the repositories in DIR, and keep them')
+    parser.add_argument('--save', metavar = 'FILE', help = 'save the results (as a baseline)')
+    parser.add_argument('--compare', metavar = 'FILE', help = 'compare the results against a baseline')
+    parser.add_argument('--threshold', type = float, default = 10,
+                        help = 'percentage by which a command may be slower than the baseline')
+    args = parser.parse_args()
+    if args.property is None:
+        args.property = ['state=new:5,in-progress:2,resolved:3', 'priority=low:2,normal:5,high:1']
+
+    tmp = args.keep or tempfile.mkdtemp(prefix = 'artemis-benchmark-')
+    hg_repo = os.path.join(tmp, 'hg')
+    git_repo = os.path.join(tmp, 'git')
+    try:
+        start = time.time()
+        subprocess.check_call(['hg', 'init', hg_repo])
+        busiest = generate(os.path.join(hg_repo, '.issues'), args)
+        shutil.copytree(os.path.join(hg_repo, '.issues'), os.path.join(git_repo, '.issues'))
+        subprocess.check_call(['git', 'init', '-q', git_repo])
+        subprocess.check_call(['git', 'config', 'user.name', user_name], cwd = git_repo)
+        subprocess.check_call(['git', 'config', 'user.email', user_email], cwd = git_repo)
+        print 'generated %d issues in %.1f s (busiest: %s)' % (args.issues, time.time() - start, busiest)
+
+        hg = ['hg', '--config', 'extensions.artemis=' + extension, '--config', 'ui.username=' + user]
+        git = [sys.executable, git_artemis]
+        if args.index:
+            subprocess.check_call(hg + ['iindex'], cwd = hg_repo)
+            subprocess.check_call(git + ['index'], cwd = git_repo)
+
+        results = []
+        for name, arguments in benchmarks:
+            arguments = [a == 'ISSUE' and busiest or a for a in arguments]
+            if args.only != 'git':
+                results.append(measure('hg ' + name, hg + arguments, hg_repo, args.runs))
+            if args.only != 'hg':
+                results.append(measure('git ' + name[1:], git + [arguments[0][1:]] + arguments[1:], git_repo, args.runs))
+    finally:
+        if not args.keep: shutil.rmtree(tmp)
+
+    parameters = dict((k, getattr(args, k)) for k in
+                      ('issues', 'comments', 'depth', 'property', 'attachment_size', 'attachment_ratio', 'seed', 'index'))
+    baseline = {}
+    if args.compare:
+        saved = json.load(open(args.compare))
+        baseline = saved['results']
+        if saved['parameters'] != parameters:
+            print 'warning: the baseline was generated with different parameters'
+
+    print '\n%-24s %9s %9s %8s' % ('', 'median ms', 'min ms', 'RSS MB'),
+    print baseline and '%12s %8s' % ('baseline ms', 'change') or ''
+    regressions = []
+    for name, result in results:
+        print '%-24s %9.1f %9.1f %8.1f' % (name, result['time'], result['min'], result['rss'] / 1024.),
+        if name in baseline:
+            change = (result['time'] / baseline[name]['time'] - 1) * 100
+            print '%12.1f %+7.1f%%' % (baseline[name]['time'], change),
+            if change > args.threshold: regressions.append(name)
+        print
+
+    if args.save:
+        json.dump({ 'parameters': parameters, 'results': dict(results) }, open(args.save, 'w'),
+                  indent = 1, sort_keys = True)
+    if regressions:
+        print '\nslower than the baseline: %s' % ', '.join(regressions)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Convert the issues in ISSUES_DIR (.issues by default) from maildirs to
+packs, or back (--to maildir). Every message keeps its key, the name of its
+file, and its bytes; converting back, only the latest version of a message
+that was changed in the pack is kept. Issues already in the target format
+are left alone, as are empty maildirs, and maildirs with messages still
+in tmp. The repository isn't touched: record the change with
+`hg addremove` or `git add -A`.
+
+    python contrib/convert-maildir-pack.py [--to packed|maildir] [ISSUES_DIR]
+"""
+
+import os, sys, shutil
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from artemis import artemis
+
+def copier(src):
+    def write(fp):
+        shutil.copyfileobj(src, fp, artemis.chunk_size)
+    return write
+
+def pack(issue):
+    tmp_dir = os.path.join(issue, 'tmp')
+    if os.path.isdir(tmp_dir) and os.listdir(tmp_dir):
+        print '%s: messages in tmp, skipped' % issue
+        return False
+    mbox = artemis.IssueMaildir(issue)
+    if not len(mbox):
+        return False
+    tmp = issue + '.pack'
+    packed = artemis.IssuePack(tmp)
+    try:
+        for key in sorted(mbox.keys(), key = mbox.name):
+            src = mbox.get_file(key)
+            try:
+                packed.add_file(copier(src), mbox.name(key))
+            finally:
+                src.close()
+    except:
+        os.remove(tmp)
+        raise
+    shutil.rmtree(issue)
+    os.rename(tmp, issue)
+    return True
+
+def unpack(issue):
+    packed = artemis.IssuePack(issue)
+    tmp = issue + '.maildir'
+    for d in artemis.maildir_dirs: os.makedirs(os.path.join(tmp, d))
+    try:
+        for key in packed.keys():
+            src = packed.get_file(key)
+            fp = open(os.path.join(tmp, packed.name(key)), 'wb')
+            try:
+                copier(src)(fp)
+            finally:
+                fp.close()
+                src.close()
+    except:
+        shutil.rmtree(tmp)
+        raise
+    packed.close()
+    os.remove(issue)
+    os.rename(tmp, issue)
+    return True
+
+def main():
+    parser = ArgumentParser(description = 'Convert issues between maildirs and packs.')
+    parser.add_argument('--to', choices = ['packed', 'maildir'], default = 'packed', help = 'the format to convert to')
+    parser.add_argument('issues_dir', nargs = '?', default = artemis.default_issues_dir)
+    args = parser.parse_args()
+
+    converted = 0
+    for issue_id in sorted(os.listdir(args.issues_dir)):
+        if issue_id.startswith('.'): continue
+        issue = os.path.join(args.issues_dir, issue_id)
+        if args.to == 'packed' and os.path.isdir(issue):
+            converted += pack(issue)
+        elif args.to == 'maildir' and os.path.isfile(issue):
+            converted += unpack(issue)
+    print 'converted %d issues' % converted
+
+if __name__ == '__main__':
+    main()